@@ -1,89 +1,146 @@
-from flask import Flask, request, render_template, url_for
-import sqlglot
-from sqlglot import expressions as exp
-import uuid
-
-from parse import build_ra_tree, visualize_ra_tree
+from flask import Flask, request, render_template, url_for, g, jsonify, abort
+import os
+import multiprocessing
+import threading
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+from parse import build_ra_tree, node_from_dict
 from pred_pushdown import pushdown_selections
 from cost_estimator import estimate_cost, visualize_costs
 from join_optimization import join_optimize
-import psycopg2
+from cardinality_feedback import CardinalityFeedback
+from sampling_estimator import SamplingEstimator
+from cost_calibration import load_profile
+from session_store import SessionStore
+from render_cache import RenderCache
+from db_stats import get_db_connection, fetch_table_statistics, explain_analyze
+import metrics
 
 app = Flask(__name__)
 
-table_stats = None
-current_tree = None
-
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(
-            dbname="tpch",
-            user="dabba",
-            password="postgres",
-            host="localhost",
-            port="5432"
-        )
-        return conn
-    except Exception as e:
-        print(f"Error connecting to the database: {e}")
-        raise
-
-def fetch_table_statistics():
-    """
-    Fetch row counts for all tables in the database using pg_stats_all_tables.
-    """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    table_stats = {}
-
+# Under `python3 app.py`, the spawned join search workers re-import this script as __mp_main__,
+# so module level only defines objects and touches no files: the store directories, the feedback
+# file, the cost profile, the worker pool and the profiler thread are all set up on first use.
+
+# Per-session optimizer state lives server-side, so any worker thread or process can serve any request.
+# The on-disk stores shared by the workers live in private directories under the instance folder.
+SESSION_COOKIE = 'optiquery_session'
+session_store = SessionStore(os.path.join(app.instance_path, 'sessions'))
+
+# Shared by all worker processes through its file, which is read on first use and again
+# whenever another worker has saved it
+cardinality_feedback = CardinalityFeedback()
+
+# Rendered graphs are cached by content; the schema graph is refetched at most every SCHEMA_TTL seconds
+render_cache = RenderCache(directory=os.path.join(app.instance_path, 'graphs'))
+SCHEMA_TTL = 300
+
+# Per-request phase timings and counters are aggregated here and exported at /metrics.
+# Set OPTIQUERY_SAMPLING_PROFILER=1 to also sample stacks of the serving threads (/metrics/profile).
+# Each worker process publishes its share to METRICS_DIR, and either endpoint reports the sum.
+METRICS_DIR = os.path.join(app.instance_path, 'metrics')
+metrics_registry = metrics.MetricsRegistry(directory=METRICS_DIR)
+sampling_profiler = metrics.SamplingProfiler(directory=METRICS_DIR)
+SAMPLING_PROFILER = os.environ.get('OPTIQUERY_SAMPLING_PROFILER') == '1'
+
+# Hardware class whose calibrated profile (profiles/<name>.json, see cost_calibration.py) prices operators.
+# Without a profile, costs are estimated row counts.
+COST_PROFILE = 'default'
+
+@lru_cache(maxsize=1)
+def get_cost_profile():
+    return load_profile(COST_PROFILE)
+
+# Join orders of large queries are searched on all cores. Workers are spawned rather than
+# forked, since the server may be running threads.
+_join_executor = None
+_join_executor_lock = threading.Lock()
+
+def get_join_executor():
+    global _join_executor
+    with _join_executor_lock:
+        if _join_executor is None:
+            _join_executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        return _join_executor
+
+# Set OPTIQUERY_SAMPLING_ESTIMATOR=1 to estimate single-table selections on a row sample when no
+# selectivity has been learned. Samples are read from samples/<table>.csv when present, otherwise
+# taken with TABLESAMPLE.
+SAMPLING_ESTIMATOR = os.environ.get('OPTIQUERY_SAMPLING_ESTIMATOR') == '1'
+selectivity_sampler = (SamplingEstimator(connect=get_db_connection, sample_dir=os.path.join(app.root_path, 'samples'))
+                       if SAMPLING_ESTIMATOR else None)
+
+@app.before_request
+def begin_request_metrics():
+    if SAMPLING_PROFILER:
+        sampling_profiler.start()
+    metrics.begin_request()
+
+@app.after_request
+def record_request_metrics(response):
+    request_metrics = metrics.end_request()
+    if request_metrics is not None:
+        metrics_registry.record(request_metrics, request.endpoint)
+        if request_metrics.timings:
+            response.headers['Server-Timing'] = request_metrics.server_timing()
+    return response
+
+@app.context_processor
+def inject_request_metrics():
+    request_metrics = metrics.current()
+    return {'request_metrics': request_metrics.to_dict() if request_metrics else None}
+
+@app.before_request
+def load_session_state():
+    g.session_id = request.cookies.get(SESSION_COOKIE)
+    # a missing or malformed cookie (which could never be stored) gets a fresh session
+    g.new_session = not session_store.valid_id(g.session_id)
+    if g.new_session:
+        g.session_id = SessionStore.new_id()
+    # the store holds plain data; a tree that no longer rebuilds is treated as an empty session
+    state = session_store.load(g.session_id)
     try:
-        cursor.execute("""
-            SELECT relname AS table_name, n_live_tup AS row_count
-            FROM pg_stat_all_tables
-            WHERE schemaname = 'public';
-        """)
-        stats = cursor.fetchall()
-
-        cnt = 0
-        for stat in stats:
-            table_name, row_count = stat
-            table_stats[table_name] = row_count
-            cnt += row_count
-
-        if(cnt == 0):
-            cursor.execute("""
-                ANALYZE;
-            """)
-            cursor.execute("""
-                SELECT relname AS table_name, n_live_tup AS row_count
-                FROM pg_stat_all_tables
-                WHERE schemaname = 'public';
-            """)
-
-            stats = cursor.fetchall()
-
-            cnt = 0
-            for stat in stats:
-                table_name, row_count = stat
-                table_stats[table_name] = row_count
-                cnt += row_count
-
-        if(cnt == 0):
-            print(f"Error: No tables found in the database.")
-
+        current_tree = state.get('current_tree')
+        g.state = {'table_stats': state.get('table_stats'),
+                   'current_tree': node_from_dict(current_tree) if current_tree else None}
     except Exception as e:
-        print(f"Error fetching table statistics: {e}")
-        raise
-    finally:
-        cursor.close()
-        conn.close()
-
-    return table_stats
+        print(f"Error restoring session {g.session_id}: {e}")
+        g.state = {}
+    g.state_changed = False
+
+@app.after_request
+def save_session_state(response):
+    if g.get('state_changed'):
+        current_tree = g.state.get('current_tree')
+        session_store.save(g.session_id, {'table_stats': g.state.get('table_stats'),
+                                          'current_tree': current_tree.to_dict() if current_tree else None})
+    if g.get('new_session'):
+        response.set_cookie(SESSION_COOKIE, g.session_id, httponly=True, samesite='Lax')
+    return response
+
+def estimate_tree_cost(tree, table_stats):
+    cardinality_feedback.reload_if_changed()
+    with metrics.timer('estimate_cost'):
+        return estimate_cost(tree, table_stats, cardinality_feedback, selectivity_sampler, get_cost_profile())
+
+def get_session_state(require_tree=True):
+    """Table statistics and working RA tree of the current session."""
+    table_stats = g.state.get('table_stats')
+    current_tree = g.state.get('current_tree')
+    if require_tree and current_tree is None:
+        raise ValueError("No query tree in this session. Generate the tree first.")
+    return table_stats, current_tree
+
+def set_session_state(table_stats, current_tree):
+    g.state = {'table_stats': table_stats, 'current_tree': current_tree}
+    g.state_changed = True
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     sql = ''
     dot_src = None
+    dot_etag = None
     error = None
 
     if request.method == 'POST':
@@ -91,19 +148,17 @@ def index():
         try:
             # Parse the SQL query and build the RA tree
 
-            global table_stats
-            global current_tree
-
             table_stats = fetch_table_statistics()
 
             current_tree = build_ra_tree(sql)
-            estimate_cost(current_tree, table_stats)
+            estimate_tree_cost(current_tree, table_stats)
+            set_session_state(table_stats, current_tree)
 
-            dot_src = visualize_ra_tree(current_tree).source
+            dot_etag, dot_src = render_cache.plan_dot(current_tree)
         except Exception as e:
             error = str(e)
 
-    return render_template('index.html', sql=sql, dot_src=dot_src, error=error)
+    return render_template('index.html', sql=sql, dot_src=dot_src, dot_etag=dot_etag, error=error)
 
 @app.route('/joinopt', methods=['POST'])
 def joinopt():
@@ -112,45 +167,48 @@ def joinopt():
     """
     sql = request.form.get('sql', '')
     dot_src = None
+    dot_etag = None
     error = None
 
     try:
         # Perform join optimization on the RA tree
 
-        global table_stats
-        global current_tree
+        table_stats, current_tree = get_session_state()
     
-        estimate_cost(current_tree, table_stats)
-        current_tree = join_optimize(current_tree)
-        estimate_cost(current_tree, table_stats)
+        estimate_tree_cost(current_tree, table_stats)
+        current_tree = join_optimize(current_tree, cardinality_feedback, get_cost_profile(), parallel=get_join_executor())
+        estimate_tree_cost(current_tree, table_stats)
+        set_session_state(table_stats, current_tree)
 
-        dot_src = visualize_ra_tree(current_tree).source
+        dot_etag, dot_src = render_cache.plan_dot(current_tree)
     except Exception as e:
         error = str(e)
 
-    return render_template('index.html', sql=sql, dot_src=dot_src, error=error)
+    return render_template('index.html', sql=sql, dot_src=dot_src, dot_etag=dot_etag, error=error)
 
 
 @app.route('/pushdown', methods=['POST'])
 def pushdown():
     sql = request.form.get('sql', '')
     dot_src = None
+    dot_etag = None
     error = None
 
     try:
         # push down selections in the RA tree
-        global table_stats
-        global current_tree
+        table_stats, current_tree = get_session_state()
 
-        estimate_cost(current_tree, table_stats)
-        current_tree = pushdown_selections(current_tree)
-        estimate_cost(current_tree, table_stats)
+        estimate_tree_cost(current_tree, table_stats)
+        with metrics.timer('pushdown'):
+            current_tree = pushdown_selections(current_tree)
+        estimate_tree_cost(current_tree, table_stats)
+        set_session_state(table_stats, current_tree)
 
-        dot_src = visualize_ra_tree(current_tree).source
+        dot_etag, dot_src = render_cache.plan_dot(current_tree)
     except Exception as e:
         error = str(e)
 
-    return render_template('index.html', sql=sql, dot_src=dot_src, error=error)
+    return render_template('index.html', sql=sql, dot_src=dot_src, dot_etag=dot_etag, error=error)
 
 @app.route('/cost', methods=['POST'])
 def cost():
@@ -164,17 +222,16 @@ def cost():
     comparison_class = None
     
     try:
-        global table_stats
-        global current_tree
+        table_stats, current_tree = get_session_state()
         
         ra_tree = build_ra_tree(sql)
 
-        estimate_cost(ra_tree, table_stats)
-        ra_tree_svg = visualize_ra_tree(ra_tree).source
+        estimate_tree_cost(ra_tree, table_stats)
+        ra_tree_svg = render_cache.plan_dot(ra_tree)[1]
         ra_tree_cost = ra_tree.cumulative_cost
 
-        estimate_cost(current_tree, table_stats)
-        current_tree_svg = visualize_ra_tree(current_tree).source
+        estimate_tree_cost(current_tree, table_stats)
+        current_tree_svg = render_cache.plan_dot(current_tree)[1]
         current_tree_cost = current_tree.cumulative_cost
 
         if ra_tree_cost > (1.001 * current_tree_cost):
@@ -203,11 +260,47 @@ def cost():
         comparison_class=comparison_class
     )
 
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    """
+    Execute the query with EXPLAIN ANALYZE and learn the observed selectivities,
+    so that later cost estimates use actual row counts instead of the defaults.
+    """
+    sql = request.form.get('sql', '')
+    dot_src = None
+    dot_etag = None
+    error = None
+
+    try:
+        table_stats, current_tree = get_session_state(require_tree=False)
+
+        plan = explain_analyze(sql)
+
+        cardinality_feedback.learn_from_explain(plan)
+        cardinality_feedback.save()
+
+        if table_stats is None:
+            table_stats = fetch_table_statistics()
+        if current_tree is None:
+            current_tree = build_ra_tree(sql)
+        estimate_tree_cost(current_tree, table_stats)
+        set_session_state(table_stats, current_tree)
+
+        dot_etag, dot_src = render_cache.plan_dot(current_tree)
+    except Exception as e:
+        error = str(e)
+
+    return render_template('index.html', sql=sql, dot_src=dot_src, dot_etag=dot_etag, error=error)
+
 @app.route('/schema', methods=['GET'])
 def get_schema_graph():
     """
     Fetch the schema of the current database and return it in DOT format for visualization.
     """
+    etag, payload = render_cache.get_expiring('schema')
+    if payload is not None:
+        return _schema_response(payload, etag)
+
     conn = get_db_connection()
     cursor = conn.cursor()
     dot_lines = [
@@ -285,7 +378,62 @@ def get_schema_graph():
         conn.close()
 
     dot_lines.append("}")
-    return {"dot": "\n".join(dot_lines), "dbname": dbname}
+    payload = {"dot": "\n".join(dot_lines), "dbname": dbname}
+    etag = render_cache.put_expiring('schema', payload, SCHEMA_TTL)
+    return _schema_response(payload, etag)
+
+def _schema_response(payload, etag):
+    # the per-request metrics vary, so the ETag only promises an equivalent schema (weak)
+    response = jsonify({**payload, "metrics": metrics.current().to_dict()})
+    return _conditional_response(response, etag, revalidate=True, weak=True)
+
+@app.route('/graph/<etag>.<fmt>', methods=['GET'])
+def get_graph(etag, fmt):
+    """
+    Serve a previously rendered plan graph by its content hash, as DOT source or SVG.
+    """
+    if fmt == 'dot':
+        content = render_cache.get_dot(etag)
+        mimetype = 'text/vnd.graphviz'
+    elif fmt == 'svg':
+        try:
+            content = render_cache.svg(etag)
+        except Exception as e:
+            return f"Error rendering graph: {e}", 500
+        mimetype = 'image/svg+xml'
+    else:
+        abort(404)
+    if content is None:
+        abort(404)
+    return _conditional_response(app.response_class(content, mimetype=mimetype), etag)
+
+def _conditional_response(response, etag, revalidate=False, weak=False):
+    """Attach the ETag and answer 304 when the client already holds this content."""
+    response.set_etag(etag, weak=weak)
+    if revalidate:
+        response.cache_control.no_cache = True
+    else:
+        # content-addressed: the body behind an ETag never changes
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Phase timings, optimizer counters and cache hit ratios in the Prometheus text format.
+    """
+    return app.response_class(metrics_registry.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/profile', methods=['GET'])
+def get_profile():
+    """
+    Stacks sampled by the opt-in sampling profiler, in folded format for flamegraph tools.
+    """
+    if request.args.get('reset'):
+        sampling_profiler.reset()
+    return app.response_class(sampling_profiler.folded(), mimetype='text/plain')
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
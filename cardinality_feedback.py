@@ -0,0 +1,390 @@
+import json
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from parse import RANode, Relation, Selection, Projection, Join, Subquery
+from file_store import atomic_write
+import metrics
+
+DEFAULT_FEEDBACK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cardinality_feedback.json')
+
+# Postgres decorates constants and columns with casts in EXPLAIN output, e.g. '1994-01-01'::date
+_CAST_RE = re.compile(r"::\w+(?: without time zone| with time zone| varying| precision)?(?:\[\])?")
+_SQL_CAST_RE = re.compile(r"\bcast\(\s*('(?:[^']|'')*'|[^()']*?)\s+as\s+[\w ]+\)", re.IGNORECASE)
+_QUALIFIER_RE = re.compile(r"\b([A-Za-z_]\w*)\.(?=[A-Za-z_])")
+_LITERAL_RE = re.compile(r"('(?:[^']|'')*')")
+_LOGICAL_RE = re.compile(r"\b(?:and|or|not)\b")
+_SPLIT_RE = re.compile(r"(\(|\)|\b(?:and|between)\b)", re.IGNORECASE)
+# EXPLAIN spells LIKE and ILIKE as operators
+_PG_OPERATORS = (('!~~*', ' not ilike '), ('~~*', ' ilike '), ('!~~', ' not like '), ('~~', ' like '))
+_BETWEEN_RE = re.compile(r"^(.*?)\s+between\s+(.+?)\s+and\s+(.+)$", re.IGNORECASE | re.DOTALL)
+_ANY_RE = re.compile(r"^(.*?)\s*(=|<>)\s*(?:any|all)\s*\(\s*'\{(.*)\}'\s*\)$", re.DOTALL)
+_IN_RE = re.compile(r"^(.*?)\s+(not\s+)?in\s*\((.*)\)$", re.DOTALL)
+_ARRAY_ITEM_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|([^,]+)')
+_NUMBER_RE = re.compile(r"-?\d+(\.\d+)?")
+
+
+def strip_where(condition: str) -> str:
+    """The condition without its leading WHERE keyword."""
+    cond = condition.strip()
+    return cond[6:].strip() if cond.upper().startswith("WHERE ") else cond
+
+
+def _strip_outer_parens(cond: str) -> str:
+    """Remove parentheses that enclose the whole condition, e.g. ((a = 1))."""
+    while cond.startswith('(') and cond.endswith(')'):
+        depth, pos = 0, 0
+        for i, part in enumerate(_LITERAL_RE.split(cond)):
+            if i % 2 == 0:
+                for j, ch in enumerate(part):
+                    depth += (ch == '(') - (ch == ')')
+                    if depth == 0 and pos + j < len(cond) - 1:
+                        return cond
+            pos += len(part)
+        cond = cond[1:-1].strip()
+    return cond
+
+
+def split_conjuncts(condition: str) -> list:
+    """
+    Split a predicate into its top-level AND-ed conditions, looking through enclosing
+    parentheses (EXPLAIN prints ((a) AND (b))) but not into literals, nested
+    parentheses or the AND of BETWEEN.
+    """
+    conjuncts, current, depth, in_between = [], [], 0, False
+    for i, part in enumerate(_LITERAL_RE.split(strip_where(condition))):
+        if i % 2:
+            current.append(part)
+            continue
+        for token in _SPLIT_RE.split(part):
+            word = token.lower()
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif depth == 0 and word == 'between':
+                in_between = True
+            elif depth == 0 and word == 'and':
+                if in_between:
+                    in_between = False
+                else:
+                    conjuncts.append(''.join(current))
+                    current = []
+                    continue
+            current.append(token)
+    conjuncts.append(''.join(current))
+
+    result = []
+    for conjunct in conjuncts:
+        conjunct = conjunct.strip()
+        inner = _strip_outer_parens(conjunct)
+        if inner != conjunct:
+            result.extend(split_conjuncts(inner))
+        elif conjunct:
+            result.append(conjunct)
+    return result
+
+
+def _list_items(items: str) -> list:
+    """Split an IN list on the commas outside string literals."""
+    values, current = [], []
+    for i, part in enumerate(_LITERAL_RE.split(items)):
+        if i % 2:
+            current.append(part)
+            continue
+        pieces = part.split(',')
+        current.append(pieces[0])
+        for piece in pieces[1:]:
+            values.append(''.join(current).strip())
+            current = [piece]
+    values.append(''.join(current).strip())
+    return [value for value in values if value]
+
+
+def _normalize_conjunct(cond: str) -> list:
+    """Canonical form(s) of one condition; BETWEEN becomes the two comparisons EXPLAIN shows."""
+    cond = _SQL_CAST_RE.sub(r"\1", _strip_outer_parens(cond))
+    between = _BETWEEN_RE.match(cond)
+    if between and not re.search(r"\bnot$", between.group(1), re.IGNORECASE):
+        column, low, high = between.groups()
+        return _normalize_conjunct(f"{column} >= {low}") + _normalize_conjunct(f"{column} <= {high}")
+
+    parts = _LITERAL_RE.split(cond)
+    for i in range(1, len(parts), 2):
+        # EXPLAIN quotes numeric constants ('10'::numeric), sqlglot does not
+        if _NUMBER_RE.fullmatch(parts[i][1:-1]):
+            parts[i] = parts[i][1:-1]
+    for i in range(0, len(parts), 2):
+        part = _CAST_RE.sub('', parts[i])
+        for operator, word in _PG_OPERATORS:
+            part = part.replace(operator, word)
+        parts[i] = _QUALIFIER_RE.sub('', part).lower()
+    cond = ' '.join(''.join(parts).split())
+
+    # x = ANY ('{a,b}') is how EXPLAIN prints x IN ('a', 'b')
+    any_match = _ANY_RE.match(cond)
+    if any_match:
+        column, operator, array = any_match.groups()
+        items = []
+        for quoted, bare in _ARRAY_ITEM_RE.findall(array):
+            value = quoted.replace('\\"', '"') if quoted else bare.strip()
+            items.append(value if _NUMBER_RE.fullmatch(value) else "'" + value.replace("'", "''") + "'")
+        cond = f"{column} {'in' if operator == '=' else 'not in'} ({', '.join(items)})"
+    in_match = _IN_RE.match(cond)
+    if in_match:
+        column, negated, items = in_match.groups()
+        cond = f"{column} {'not in' if negated else 'in'} ({', '.join(sorted(_list_items(items)))})"
+
+    parts = _LITERAL_RE.split(cond)
+    for i in range(0, len(parts), 2):
+        parts[i] = parts[i].replace('(', ' ').replace(')', ' ')
+    cond = ' '.join(''.join(parts).split())
+
+    if cond.count('=') == 1 and not re.search(r'[<>!]=', cond) and not _LOGICAL_RE.search(cond):
+        lhs, rhs = (side.strip() for side in cond.split('='))
+        cond = ' = '.join(sorted((lhs, rhs)))
+    return [cond]
+
+
+@lru_cache(maxsize=4096)
+def normalize_predicate(condition: str) -> str:
+    """
+    Reduce a predicate to a canonical form so that the same filter written by sqlglot
+    and reported by EXPLAIN ANALYZE maps to the same key.
+    The predicate is split into its AND-ed conditions, each stripped of WHERE, casts, table
+    qualifiers, parentheses and case outside string literals, with EXPLAIN's spellings
+    (~~, = ANY ('{...}'), BETWEEN as >= AND <=) mapped to one form; the sorted, distinct
+    conditions are joined with ' and '.
+    """
+    conjuncts = set()
+    for conjunct in split_conjuncts(condition):
+        conjuncts.update(_normalize_conjunct(conjunct))
+    return ' and '.join(sorted(conjuncts))
+
+
+def referenced_aliases(condition: str) -> set:
+    """Collect the qualifiers (t1 in t1.a) used outside string literals."""
+    parts = _LITERAL_RE.split(condition)
+    return {m.group(1) for part in parts[0::2] for m in _QUALIFIER_RE.finditer(_CAST_RE.sub('', part))}
+
+
+def alias_tables(node: RANode) -> dict:
+    """Map every alias and table name in scope under this RA node to the base tables it covers."""
+    if isinstance(node, Relation):
+        table = frozenset([node.table_name.lower()])
+        return {node.get_alias(): table, node.table_name: table}
+
+    if isinstance(node, Subquery):
+        inner = alias_tables(node.child)
+        tables = frozenset().union(*inner.values()) if inner else frozenset()
+        return {node.alias: tables} if node.alias else inner
+
+    if isinstance(node, (Selection, Projection)):
+        return alias_tables(node.child)
+
+    if isinstance(node, Join):
+        return {**alias_tables(node.left), **alias_tables(node.right)}
+
+    return {}
+
+
+def relation_set(condition: str, alias_map: dict) -> frozenset:
+    """
+    Base tables a predicate touches, resolved through alias_map.
+    Falls back to every table in scope when the predicate has unqualified columns.
+    """
+    aliases = referenced_aliases(condition)
+    tables = frozenset().union(*(alias_map[a] for a in aliases if a in alias_map)) if aliases else frozenset()
+    if not tables:
+        tables = frozenset().union(*alias_map.values()) if alias_map else frozenset()
+    return tables
+
+
+def total_rows(node: dict) -> float:
+    """Rows an EXPLAIN ANALYZE plan node produced over all its loops."""
+    return node.get('Actual Rows', 0) * node.get('Actual Loops', 1)
+
+
+def join_rows(node: dict) -> tuple:
+    """
+    (outer, inner, output) rows of one execution of a two-input join node in an EXPLAIN ANALYZE
+    plan. Rows are reported per loop: the inner side of a nested loop is rescanned once per outer
+    row and the workers under a Gather each run the join, so the outer side is scaled from its
+    total. A parallel-aware Hash is shared by the workers, each building part of it.
+    """
+    outer, inner = node['Plans'][:2]
+    loops = node.get('Actual Loops', 1) or 1
+    inner_rows = total_rows(inner) if inner.get('Parallel Aware') else inner.get('Actual Rows', 0)
+    return total_rows(outer) / loops, inner_rows, node.get('Actual Rows', 0)
+
+
+class CardinalityFeedback:
+    """
+    Bounded store of selectivities observed at execution time, keyed by
+    (normalized predicate, relation set). Entries older than max_age seconds are
+    treated as stale and evicted; when full the least recently used entry is dropped.
+    """
+
+    def __init__(self, path=DEFAULT_FEEDBACK_PATH, max_entries=10000, max_age=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()    # (predicate, relations) -> (selectivity, observed_at)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._mtime = None               # st_mtime_ns of self.path when last read or written
+
+    @staticmethod
+    def key(condition: str, relations) -> tuple:
+        return normalize_predicate(condition), frozenset(r.lower() for r in relations)
+
+    def lookup(self, condition: str, relations):
+        """Return the learned selectivity for this predicate, or None if unknown or stale."""
+        key = self.key(condition, relations)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                metrics.incr('feedback_misses')
+                return None
+            selectivity, observed_at = entry
+            if time.time() - observed_at > self.max_age:
+                del self._entries[key]
+                metrics.incr('feedback_misses')
+                return None
+            self._entries.move_to_end(key)
+            metrics.incr('feedback_hits')
+            return selectivity
+
+    def record(self, condition: str, relations, input_rows: float, output_rows: float):
+        """Store the selectivity output_rows / input_rows observed for this predicate."""
+        if input_rows <= 0:
+            return
+        selectivity = min(1.0, max(0.0, output_rows / input_rows))
+        key = self.key(condition, relations)
+        with self._lock:
+            self._entries[key] = (selectivity, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def evict_stale(self):
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (_, ts) in self._entries.items() if now - ts > self.max_age]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def learn_from_explain(self, plan):
+        """
+        Learn selectivities from the output of EXPLAIN (ANALYZE, FORMAT JSON).
+        Accepts the parsed JSON (list or dict) or the raw JSON string.
+        Scan filters give per-table selectivities; hash, merge and filtered nested-loop
+        joins give join selectivities relative to the cross product of their inputs.
+        """
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        if isinstance(plan, list):
+            plan = plan[0]
+        if 'Plan' in plan:
+            plan = plan['Plan']
+        self._learn_node(plan)
+
+    def _learn_node(self, node: dict) -> dict:
+        """Walk a plan node bottom-up, returning its alias -> tables map."""
+        alias_map = {}
+        children = node.get('Plans', [])
+        for child in children:
+            alias_map.update(self._learn_node(child))
+
+        if 'Relation Name' in node:
+            table = frozenset([node['Relation Name'].lower()])
+            alias_map[node.get('Alias', node['Relation Name'])] = table
+            alias_map[node['Relation Name']] = table
+
+        out_rows = total_rows(node)
+
+        if 'Filter' in node and 'Relation Name' in node:
+            removed = node.get('Rows Removed by Filter', 0) * node.get('Actual Loops', 1)
+            self.record(node['Filter'], alias_map[node['Relation Name']], out_rows + removed, out_rows)
+
+        join_cond = node.get('Hash Cond') or node.get('Merge Cond')
+        if join_cond is None and node.get('Node Type') == 'Nested Loop':
+            join_cond = node.get('Join Filter')
+        if join_cond is not None and len(children) == 2:
+            outer_rows, inner_rows, output_rows = join_rows(node)
+            self.record(join_cond, relation_set(join_cond, alias_map), outer_rows * inner_rows, output_rows)
+
+        return alias_map
+
+    def _read_file(self):
+        """Entries stored in self.path, or an empty list if it is missing or unreadable."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return [((predicate, frozenset(relations)), (selectivity, observed_at))
+                    for predicate, relations, selectivity, observed_at in data.get('entries', [])]
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            print(f"Error loading cardinality feedback from {self.path}: {e}")
+            return []
+
+    def _merge(self, entries):
+        """Adopt entries observed more recently than ours. Caller holds self._lock."""
+        now = time.time()
+        for key, (selectivity, observed_at) in entries:
+            if now - observed_at > self.max_age:
+                continue
+            current = self._entries.get(key)
+            if current is None or current[1] < observed_at:
+                self._entries[key] = (selectivity, observed_at)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload_if_changed(self):
+        """
+        Merge in entries saved by other processes since we last read or wrote the file.
+        Costs a single stat() when nothing changed.
+        """
+        mtime = self._file_mtime()
+        if mtime is None or mtime == self._mtime:
+            return
+        entries = self._read_file()
+        with self._lock:
+            self._merge(entries)
+            self._mtime = mtime
+
+    @classmethod
+    def load(cls, path=DEFAULT_FEEDBACK_PATH, **kwargs):
+        store = cls(path, **kwargs)
+        store.reload_if_changed()
+        return store
+
+    def save(self):
+        """
+        Write the store atomically, first merging what other processes have saved so
+        their observations are not overwritten.
+        """
+        with self._save_lock:
+            entries = self._read_file()
+            now = time.time()
+            with self._lock:
+                self._merge(entries)
+                for key in [k for k, (_, ts) in self._entries.items() if now - ts > self.max_age]:
+                    del self._entries[key]
+                entries = [[pred, sorted(rels), sel, ts] for (pred, rels), (sel, ts) in self._entries.items()]
+
+            atomic_write(self.path, json.dumps({'entries': entries}))
+            self._mtime = self._file_mtime()
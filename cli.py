@@ -0,0 +1,64 @@
+"""
+One-shot optimization from the command line, without the web application.
+
+    python cli.py "SELECT ... FROM ..." --stats stats.json --pushdown --joinopt
+    python cli.py "SELECT ... FROM ..." --db --joinopt --dot
+
+Only sqlglot is required; psycopg2 is loaded for --db and graphviz for --dot.
+"""
+import argparse
+import json
+import sys
+
+from parse import build_ra_tree
+from pred_pushdown import pushdown_selections
+from cost_estimator import estimate_cost
+from join_optimization import join_optimize
+from cost_calibration import load_profile
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build, optimize and cost the RA tree of an SQL query.")
+    parser.add_argument('sql', help="query to optimize, or '-' to read it from stdin")
+    parser.add_argument('--stats', help="JSON file mapping table name to row count")
+    parser.add_argument('--db', action='store_true', help="fetch row counts from the database (needs psycopg2)")
+    parser.add_argument('--profile', help="calibrated cost profile name (profiles/<name>.json)")
+    parser.add_argument('--pushdown', action='store_true', help="apply predicate pushdown")
+    parser.add_argument('--joinopt', action='store_true', help="apply join order optimization")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes for join order search")
+    parser.add_argument('--dot', action='store_true', help="print the DOT graph instead of the tree (needs graphviz)")
+    args = parser.parse_args(argv)
+
+    sql = sys.stdin.read() if args.sql == '-' else args.sql
+    if args.db:
+        from db_stats import fetch_table_statistics
+
+        table_stats = fetch_table_statistics()
+    elif args.stats:
+        with open(args.stats) as f:
+            table_stats = {table.lower(): rows for table, rows in json.load(f).items()}
+    else:
+        table_stats = {}
+    profile = load_profile(args.profile) if args.profile else None
+
+    tree = build_ra_tree(sql)
+    estimate_cost(tree, table_stats, profile=profile)
+    original_cost = tree.cumulative_cost
+
+    if args.pushdown:
+        tree = pushdown_selections(tree)
+        estimate_cost(tree, table_stats, profile=profile)
+    if args.joinopt:
+        tree = join_optimize(tree, profile=profile, parallel=args.workers)
+        estimate_cost(tree, table_stats, profile=profile)
+
+    if args.dot:
+        print(tree.to_dot().source)
+    else:
+        print(tree)
+        print(f"Original cumulative cost: {original_cost:.2e}")
+        print(f"Current cumulative cost:  {tree.cumulative_cost:.2e}")
+
+
+if __name__ == '__main__':
+    main()
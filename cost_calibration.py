@@ -0,0 +1,280 @@
+"""
+Fits the cost model's per-operator coefficients to measured runtimes.
+
+Operator timings come from EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) plans, either by running
+a training workload against the database or from saved plan files. The fitted profile is
+written to profiles/<name>.json and picked up by estimate_cost, so that cumulative costs
+are expressed in milliseconds on the hardware the workload ran on.
+
+    python cost_calibration.py --name laptop --dsn "dbname=tpch user=dabba" --workload queries.sql
+    python cost_calibration.py --name laptop --explain-files plans/*.json
+"""
+import argparse
+import json
+import os
+import statistics
+
+from cardinality_feedback import join_rows, total_rows
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+
+COEFFICIENTS = ('cpu_tuple', 'io_page', 'filter_tuple', 'hash_build_tuple', 'hash_probe_tuple', 'output_tuple')
+
+SCAN_TYPES = {'Seq Scan', 'Index Scan', 'Index Only Scan', 'Bitmap Heap Scan'}
+
+
+class CostProfile:
+    """
+    Per-operator cost coefficients in milliseconds per tuple (or per page), plus the default
+    selectivities observed on the training workload. Coefficients the workload gave no
+    measurements for are left out and listed by unfitted(); such a profile is not saved or loaded.
+    """
+
+    def __init__(self, name='default', coefficients=None, selection_selectivity=0.1, join_selectivity=0.01,
+                 tuples_per_page=50.0):
+        self.name = name
+        self.coefficients = dict(coefficients or {})
+        self.selection_selectivity = selection_selectivity
+        self.join_selectivity = join_selectivity
+        self.tuples_per_page = tuples_per_page
+
+    def unfitted(self):
+        return [c for c in COEFFICIENTS if c not in self.coefficients]
+
+    def scan_cost(self, rows):
+        c = self.coefficients
+        return c['cpu_tuple'] * rows + c['io_page'] * rows / self.tuples_per_page
+
+    def filter_cost(self, input_rows):
+        return self.coefficients['filter_tuple'] * input_rows
+
+    def project_cost(self, rows):
+        return self.coefficients['cpu_tuple'] * rows
+
+    def join_cost(self, left_rows, right_rows, output_rows):
+        """Hash join with the right input as the build side."""
+        c = self.coefficients
+        return c['hash_probe_tuple'] * left_rows + c['hash_build_tuple'] * right_rows + c['output_tuple'] * output_rows
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'coefficients': self.coefficients,
+            'selection_selectivity': self.selection_selectivity,
+            'join_selectivity': self.join_selectivity,
+            'tuples_per_page': self.tuples_per_page,
+        }
+
+    def save(self, path=None):
+        if self.unfitted():
+            raise ValueError(f"Coefficients not fitted: {', '.join(self.unfitted())}")
+        path = path or profile_path(self.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            profile = cls(**json.load(f))
+        if profile.unfitted():
+            raise ValueError(f"Coefficients not fitted: {', '.join(profile.unfitted())}")
+        return profile
+
+
+def profile_path(name):
+    return os.path.join(PROFILE_DIR, f"{name}.json")
+
+
+def load_profile(name):
+    """Load profiles/<name>.json, or return None if this hardware class has not been calibrated."""
+    path = profile_path(name)
+    if not os.path.exists(path):
+        return None
+    try:
+        return CostProfile.load(path)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Error loading cost profile {path}: {e}")
+        return None
+
+
+def _total_time(node, concurrency=1):
+    """
+    Elapsed milliseconds of a node over all its loops. Times are reported per loop; loops run
+    one after another, except under a Gather, where `concurrency` processes run them at once.
+    """
+    return node.get('Actual Total Time', 0.0) * node.get('Actual Loops', 1) / concurrency
+
+
+def _node_features(node):
+    """Map a plan node to the coefficient features its exclusive runtime depends on."""
+    node_type = node.get('Node Type')
+    children = node.get('Plans', [])
+    loops = node.get('Actual Loops', 1)
+
+    if node_type in SCAN_TYPES:
+        scanned = total_rows(node) + node.get('Rows Removed by Filter', 0) * loops
+        features = {
+            'cpu_tuple': scanned,
+            'io_page': node.get('Shared Hit Blocks', 0) + node.get('Shared Read Blocks', 0),
+        }
+        if 'Filter' in node:
+            features['filter_tuple'] = scanned
+        return features
+
+    if node_type == 'Hash':
+        return {'hash_build_tuple': total_rows(node)}
+
+    if node_type == 'Hash Join' and len(children) == 2:
+        return {'hash_probe_tuple': total_rows(children[0]), 'output_tuple': total_rows(node)}
+
+    return None
+
+
+def collect_observations(plan, observations=None, selectivities=None, concurrency=1):
+    """
+    Walk an EXPLAIN (ANALYZE, FORMAT JSON) plan and collect (features, exclusive_ms) pairs,
+    along with observed selection and join selectivities. Under a Gather, exclusive times are
+    elapsed times and features are divided among the `concurrency` processes running the plan.
+    """
+    observations = [] if observations is None else observations
+    selectivities = {'selection': [], 'join': [], 'tuples_per_page': []} if selectivities is None else selectivities
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    if isinstance(plan, list):
+        for entry in plan:
+            collect_observations(entry, observations, selectivities, concurrency)
+        return observations, selectivities
+    if 'Plan' in plan:
+        plan = plan['Plan']
+
+    children = plan.get('Plans', [])
+    child_concurrency = concurrency
+    if plan.get('Node Type') in ('Gather', 'Gather Merge') and children:
+        # the leader and the launched workers each run the parallel plan once
+        child_concurrency = max(1, children[0].get('Actual Loops', 1))
+    for child in children:
+        collect_observations(child, observations, selectivities, child_concurrency)
+
+    exclusive = _total_time(plan, concurrency) - sum(_total_time(child, child_concurrency) for child in children)
+    features = _node_features(plan)
+    if features is not None:
+        features = {name: value / concurrency for name, value in features.items()}
+        observations.append((features, max(0.0, exclusive)))
+
+    if 'Filter' in plan and plan.get('Node Type') in SCAN_TYPES:
+        removed = plan.get('Rows Removed by Filter', 0) * plan.get('Actual Loops', 1)
+        if total_rows(plan) + removed > 0:
+            selectivities['selection'].append(total_rows(plan) / (total_rows(plan) + removed))
+    if plan.get('Node Type') == 'Seq Scan':
+        pages = plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0)
+        if pages > 0:
+            scanned = total_rows(plan) + plan.get('Rows Removed by Filter', 0) * plan.get('Actual Loops', 1)
+            selectivities['tuples_per_page'].append(scanned / pages)
+    if plan.get('Node Type') in ('Hash Join', 'Merge Join') and len(children) == 2:
+        outer_rows, inner_rows, output_rows = join_rows(plan)
+        if outer_rows * inner_rows > 0:
+            selectivities['join'].append(output_rows / (outer_rows * inner_rows))
+
+    return observations, selectivities
+
+
+def _fit_nonnegative(observations, names, iterations=200):
+    """
+    Non-negative least squares by cyclic coordinate descent: time ~= sum(coef * feature).
+    Coefficients whose feature never occurs are left out of the result.
+    """
+    coef = {n: 0.0 for n in names}
+    residual = [t for _, t in observations]
+    norms = {n: sum(f.get(n, 0) ** 2 for f, _ in observations) for n in names}
+
+    for _ in range(iterations):
+        for n in names:
+            if norms[n] == 0:
+                continue
+            correlation = sum(f.get(n, 0) * r for (f, _), r in zip(observations, residual))
+            updated = max(0.0, coef[n] + correlation / norms[n])
+            delta = updated - coef[n]
+            if delta:
+                residual = [r - delta * f.get(n, 0) for (f, _), r in zip(observations, residual)]
+                coef[n] = updated
+    return {n: value for n, value in coef.items() if norms[n] > 0}
+
+
+def fit_profile(plans, name='default'):
+    observations, selectivities = [], {'selection': [], 'join': [], 'tuples_per_page': []}
+    for plan in plans:
+        collect_observations(plan, observations, selectivities)
+    if not observations:
+        raise ValueError("No calibratable operators found in the supplied plans")
+
+    defaults = CostProfile()
+    return CostProfile(
+        name=name,
+        coefficients=_fit_nonnegative(observations, COEFFICIENTS),
+        selection_selectivity=statistics.median(selectivities['selection']) if selectivities['selection'] else defaults.selection_selectivity,
+        join_selectivity=statistics.median(selectivities['join']) if selectivities['join'] else defaults.join_selectivity,
+        tuples_per_page=statistics.median(selectivities['tuples_per_page']) if selectivities['tuples_per_page'] else defaults.tuples_per_page,
+    )
+
+
+def run_workload(queries, conn):
+    """Execute each training query under EXPLAIN ANALYZE and return the JSON plans."""
+    plans = []
+    cursor = conn.cursor()
+    try:
+        for query in queries:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query)
+            plans.append(cursor.fetchone()[0])
+            conn.rollback()
+    finally:
+        cursor.close()
+    return plans
+
+
+def load_explain_files(paths):
+    plans = []
+    for path in paths:
+        with open(path) as f:
+            plans.append(json.load(f))
+    return plans
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate OptiQuery cost coefficients against measured runtimes.")
+    parser.add_argument('--name', default='default', help="hardware class; the profile is saved to profiles/<name>.json")
+    parser.add_argument('--workload', help="file of ';'-separated training queries to run with EXPLAIN ANALYZE")
+    parser.add_argument('--dsn', help="psycopg2 connection string used with --workload")
+    parser.add_argument('--explain-files', nargs='*', default=[], help="saved EXPLAIN (ANALYZE, FORMAT JSON) outputs")
+    args = parser.parse_args()
+
+    plans = load_explain_files(args.explain_files)
+    if args.workload:
+        import psycopg2
+
+        with open(args.workload) as f:
+            queries = [q.strip() for q in f.read().split(';') if q.strip()]
+        conn = psycopg2.connect(args.dsn or '')
+        try:
+            plans += run_workload(queries, conn)
+        finally:
+            conn.close()
+
+    if not plans:
+        parser.error("supply --workload or --explain-files")
+
+    profile = fit_profile(plans, args.name)
+    if profile.unfitted():
+        print("Not saving the profile: the plans measure no operator for "
+              f"{', '.join(profile.unfitted())}. Add queries exercising them (and use EXPLAIN with BUFFERS).")
+        raise SystemExit(1)
+    path = profile.save()
+    print(f"Saved cost profile to {path}")
+    for coef, value in profile.coefficients.items():
+        print(f"  {coef}: {value:.3e} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,97 +1,125 @@
 from parse import RANode, Relation, Selection, Projection, Join, Subquery
-from graphviz import Digraph
 
 from pred_pushdown import extract_columns
+from cardinality_feedback import alias_tables, relation_set, referenced_aliases, strip_where
 
-def estimate_cost(node: RANode, table_stats: dict):
+def _base_relations(node: RANode):
+    """Relations directly in scope under this node (not those hidden inside subqueries)."""
+    if isinstance(node, Relation):
+        return [node]
+    if isinstance(node, (Selection, Projection)):
+        return _base_relations(node.child)
+    if isinstance(node, Join):
+        return _base_relations(node.left) + _base_relations(node.right)
+    return []
+
+def _sampled_selectivity(node: Selection, sampler):
+    """Evaluate the selection on a table sample when it only references a single base relation."""
+    relations = _base_relations(node.child)
+    aliases = referenced_aliases(node.condition)
+    if aliases:
+        targets = [rel for rel in relations if rel.get_alias() in aliases or rel.table_name in aliases]
+    else:
+        targets = relations
+    if len(targets) != 1:
+        return None
+    if aliases and not aliases <= {targets[0].get_alias(), targets[0].table_name}:
+        return None
+    return sampler.selectivity(targets[0].table_name, targets[0].get_alias(), node.condition)
+
+def _learned_selectivity(node: Selection, feedback, child_rows):
+    """
+    Learned selectivity of a selection and the row count it applies to. EXPLAIN reports all the
+    filters of a scan as one conjunction while pushdown leaves one Selection per condition, so the
+    stack of selections ending at this node is looked up as a whole before its own condition.
+    """
+    conditions, below = [node.condition], node.child
+    while isinstance(below, Selection):
+        conditions.append(below.condition)
+        below = below.child
+    if len(conditions) > 1:
+        combined = ' AND '.join(f"({strip_where(condition)})" for condition in conditions)
+        learned = feedback.lookup(combined, relation_set(combined, alias_tables(below)))
+        if learned is not None:
+            return learned, below.rows
+    return feedback.lookup(node.condition, relation_set(node.condition, alias_tables(node.child))), child_rows
+
+def estimate_cost(node: RANode, table_stats: dict, feedback=None, sampler=None, profile=None):
     """
     Recursively computes the cost of each node in the RA tree using pre-fetched table and column statistics.
-    Annotates the cost and cumulative cost at each node for visualization.
+    Selectivities learned from executed queries (a CardinalityFeedback store) take precedence over the defaults,
+    followed by selectivities measured on a table sample (a SamplingEstimator) for single-table selections.
+    Without a calibrated CostProfile the cost of a node is its estimated row count; with one it is the
+    operator's predicted runtime in milliseconds.
+    Annotates the estimated rows, cost and cumulative cost at each node and returns the row count.
     """
     if isinstance(node, Relation):
         # Get the size of the relation from the pre-fetched statistics
         table_name = node.table_name.lower()
         row_count = table_stats.get(table_name, 0)
-        node.cost = row_count
-        node.cumulative_cost = row_count  # For a leaf node, cumulative cost is the same as its cost
-        return row_count
+        node.rows = row_count
+        node.cost = profile.scan_cost(row_count) if profile else row_count
+        node.cumulative_cost = node.cost  # For a leaf node, cumulative cost is the same as its cost
+        return node.rows
 
     elif isinstance(node, Selection):
         # Estimate the size of the selection dynamically
-        child_cost = estimate_cost(node.child, table_stats)
-        filtered_count = child_cost * 0.1
-        node.cost = max(10, filtered_count)
+        child_rows = estimate_cost(node.child, table_stats, feedback, sampler, profile)
+        learned, input_rows = None, child_rows
+        if feedback is not None:
+            learned, input_rows = _learned_selectivity(node, feedback, child_rows)
+        if learned is None and sampler is not None:
+            learned, input_rows = _sampled_selectivity(node, sampler), child_rows
+        if learned is not None:
+            node.rows = input_rows * learned
+        else:
+            filtered_count = child_rows * (profile.selection_selectivity if profile else 0.1)
+            node.rows = max(10, filtered_count)
+        node.cost = profile.filter_cost(child_rows) if profile else node.rows
         node.cumulative_cost = node.cost + node.child.cumulative_cost
-        return node.cost
+        return node.rows
 
     elif isinstance(node, Projection):
         # Projection does not change the row count
-        child_cost = estimate_cost(node.child, table_stats)
-        node.cost = child_cost
+        node.rows = estimate_cost(node.child, table_stats, feedback, sampler, profile)
+        node.cost = profile.project_cost(node.rows) if profile else node.rows
         node.cumulative_cost = node.cost + node.child.cumulative_cost
-        return node.cost
+        return node.rows
 
     elif isinstance(node, Join):
         # Estimate the size of the join dynamically
-        left_cost = estimate_cost(node.left, table_stats)
-        right_cost = estimate_cost(node.right, table_stats)
-        join_count = left_cost * right_cost * 0.01
-        node.cost = max(50, join_count)
+        left_rows = estimate_cost(node.left, table_stats, feedback, sampler, profile)
+        right_rows = estimate_cost(node.right, table_stats, feedback, sampler, profile)
+        learned = None
+        if feedback is not None:
+            learned = feedback.lookup(node.condition, relation_set(node.condition, alias_tables(node)))
+        if learned is not None:
+            node.rows = left_rows * right_rows * learned
+        else:
+            join_count = left_rows * right_rows * (profile.join_selectivity if profile else 0.01)
+            node.rows = max(50, join_count)
+        node.cost = profile.join_cost(left_rows, right_rows, node.rows) if profile else node.rows
         node.cumulative_cost = node.cost + node.left.cumulative_cost + node.right.cumulative_cost
-        return node.cost
+        return node.rows
 
     elif isinstance(node, Subquery):
-        # Estimate the cost of the subquery
-        child_cost = estimate_cost(node.child, table_stats)
-        node.cost = child_cost
+        # A subquery only renames its child's output
+        node.rows = estimate_cost(node.child, table_stats, feedback, sampler, profile)
+        node.cost = 0 if profile else node.rows
         node.cumulative_cost = node.cost + node.child.cumulative_cost
-        return node.cost
+        return node.rows
 
     else:
+        node.rows = 10
         node.cost = 10
         node.cumulative_cost = 50
         return 10
 
 def visualize_costs(ra_tree: RANode):
     """
-    Generates an SVG visualization of the RA tree with costs and cumulative costs annotated at each node.
-    Returns the SVG content as a string.
+    Builds the graph of the RA tree with costs and cumulative costs annotated at each node.
+    Returns the graphviz Digraph, set to render as PNG.
     """
-    dot = Digraph()
-
-    def add_node(dot, node):
-        if isinstance(node, Relation):
-            label = f"Relation: {node.table_name}\nCost: {node.cost}\nCumulative Cost: {node.cumulative_cost}"
-        elif isinstance(node, Selection):
-            label = f"Selection: {node.condition}\nCost: {node.cost}\nCumulative Cost: {node.cumulative_cost}"
-        elif isinstance(node, Projection):
-            label = f"Projection: {', '.join(node.columns)}\nCost: {node.cost}\nCumulative Cost: {node.cumulative_cost}"
-        elif isinstance(node, Join):
-            label = f"Join: {node.condition}\nCost: {node.cost}\nCumulative Cost: {node.cumulative_cost}"
-        elif isinstance(node, Subquery):
-            label = f"Subquery: {node.alias}\nCost: {node.cost}\nCumulative Cost: {node.cumulative_cost}"
-        else:
-            label = f"Unknown Node\nCost: {node.cost}\nCumulative Cost: {node.cumulative_cost}"
-
-        node_id = str(id(node))
-        dot.node(node_id, label)
-
-        if hasattr(node, 'child') and node.child:
-            child_id = str(id(node.child))
-            add_node(dot, node.child)
-            dot.edge(node_id, child_id)
-
-        if hasattr(node, 'left') and node.left:
-            left_id = str(id(node.left))
-            add_node(dot, node.left)
-            dot.edge(node_id, left_id)
-
-        if hasattr(node, 'right') and node.right:
-            right_id = str(id(node.right))
-            add_node(dot, node.right)
-            dot.edge(node_id, right_id)
-
-    add_node(dot, ra_tree)
-    dot = ra_tree.to_dot()  # Use the `to_dot` method from the RANode class
+    dot = ra_tree.to_dot()  # node labels already carry the annotated costs
     dot.format = 'png'
-    return dot
\ No newline at end of file
+    return dot
@@ -0,0 +1,113 @@
+# Database access for the optional statistics layer. psycopg2 is imported on first
+# connection, so the optimizer modules and the CLI do not depend on it.
+import metrics
+
+def get_db_connection():
+    import psycopg2
+
+    try:
+        conn = psycopg2.connect(
+            dbname="tpch",
+            user="dabba",
+            password="postgres",
+            host="localhost",
+            port="5432"
+        )
+        return conn
+    except Exception as e:
+        print(f"Error connecting to the database: {e}")
+        raise
+
+@metrics.timed('catalog_io')
+def fetch_table_statistics():
+    """
+    Fetch row counts for all tables in the database using pg_stats_all_tables.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    table_stats = {}
+
+    try:
+        cursor.execute("""
+            SELECT relname AS table_name, n_live_tup AS row_count
+            FROM pg_stat_all_tables
+            WHERE schemaname = 'public';
+        """)
+        stats = cursor.fetchall()
+
+        cnt = 0
+        for stat in stats:
+            table_name, row_count = stat
+            table_stats[table_name] = row_count
+            cnt += row_count
+
+        if(cnt == 0):
+            cursor.execute("""
+                ANALYZE;
+            """)
+            cursor.execute("""
+                SELECT relname AS table_name, n_live_tup AS row_count
+                FROM pg_stat_all_tables
+                WHERE schemaname = 'public';
+            """)
+
+            stats = cursor.fetchall()
+
+            cnt = 0
+            for stat in stats:
+                table_name, row_count = stat
+                table_stats[table_name] = row_count
+                cnt += row_count
+
+        if(cnt == 0):
+            print(f"Error: No tables found in the database.")
+
+    except Exception as e:
+        print(f"Error fetching table statistics: {e}")
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+    return table_stats
+
+# Longest a user query may run under EXPLAIN ANALYZE, in milliseconds
+ANALYZE_TIMEOUT_MS = 30000
+
+def single_select(sql):
+    """
+    Parse user SQL and return it regenerated as exactly one read-only SELECT.
+    Raises ValueError for multiple statements or anything else (DML, DDL, SELECT INTO,
+    data-modifying CTEs), so that only the parsed statement ever reaches the database.
+    """
+    import sqlglot
+    from sqlglot import expressions as exp
+
+    statements = [s for s in sqlglot.parse(sql, read='postgres') if s is not None]
+    if len(statements) != 1:
+        raise ValueError("Only a single SELECT statement can be executed")
+    statement = statements[0]
+    if not isinstance(statement, exp.Select) or statement.args.get('into') is not None:
+        raise ValueError("Only a single SELECT statement can be executed")
+    if statement.find(exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Create, exp.Drop, exp.Command):
+        raise ValueError("Only a single SELECT statement can be executed")
+    return statement.sql(dialect='postgres')
+
+@metrics.timed('explain_analyze')
+def explain_analyze(sql, timeout_ms=ANALYZE_TIMEOUT_MS):
+    """
+    Run a user query under EXPLAIN (ANALYZE, FORMAT JSON) in a read-only transaction
+    with a statement timeout, and return the plan.
+    """
+    query = single_select(sql)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SET TRANSACTION READ ONLY")
+        cursor.execute("SET LOCAL statement_timeout = %s", (int(timeout_ms),))
+        cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query)
+        return cursor.fetchone()[0]
+    finally:
+        conn.rollback()
+        cursor.close()
+        conn.close()
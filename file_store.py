@@ -0,0 +1,72 @@
+"""
+Filesystem helpers shared by the on-disk stores (sessions, rendered graphs, cardinality
+feedback, metrics snapshots) that every worker process of the server reads and writes.
+"""
+import os
+import stat
+import tempfile
+import threading
+import time
+
+_checked_dirs = set()
+_checked_lock = threading.Lock()
+
+
+def private_dir(path: str) -> str:
+    """
+    Create `path` with mode 0700 if needed and make sure it is a real directory owned by
+    this user that nobody else can write to, so its files can be trusted. Returns path.
+    """
+    with _checked_lock:
+        if path in _checked_dirs:
+            return path
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{path} must be a directory owned by this user with mode 0700")
+    with _checked_lock:
+        _checked_dirs.add(path)
+    return path
+
+
+def atomic_write(path: str, data):
+    """Replace the file at path with data (str or bytes), so readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def evict_older_than(directory: str, max_age: float):
+    """Delete the files in directory untouched for max_age seconds."""
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class PeriodicSweep:
+    """Runs evict_older_than(directory, max_age) on every `every`-th call to tick()."""
+
+    def __init__(self, directory: str, max_age: float, every: int):
+        self.directory = directory
+        self.max_age = max_age
+        self.every = every
+        self._ticks = 0
+        self._lock = threading.Lock()
+
+    def tick(self):
+        with self._lock:
+            self._ticks += 1
+            due = self._ticks % self.every == 0
+        if due:
+            evict_older_than(self.directory, self.max_age)
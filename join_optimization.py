@@ -1,10 +1,13 @@
-from graphviz import Digraph
-import uuid
 from parse import RANode, Relation, Selection, Projection, Join, Subquery, COLOR_MAP
+import os
+import pickle
 import re
-import sqlglot
-from sqlglot import parse_one, expressions as exp
-from itertools import permutations
+from itertools import islice
+from cardinality_feedback import alias_tables
+import metrics
+
+# Below this many subsets in a DP level, shipping the level to worker processes costs more than expanding it
+PARALLEL_MIN_STATES = 2048
 
 def extract_tables(condition: str):
     """Roughly extract identifiers like sq.a, t1.b from condition."""
@@ -17,22 +20,20 @@ def extract_tables(condition: str):
                 tables.append(token.strip().split('.')[0])
     return tables
 
-temp_root = 0
-
 def _find_joins(node: RANode, edges: list[tuple[str,str,str]], alias_to_RANode: dict[str,RANode], join_obtained: int, parent: RANode):
+    """Collect the join edges and their inputs; returns the node the reordered joins hang from."""
+    join_parent = None
     if join_obtained == 0:
         if isinstance(node,Join):
             if node.condition.upper() != "TRUE":
-                global temp_root
-
-                temp_root = parent
+                join_parent = parent
                 join_obtained = 1
             else:
-                _find_joins(node.left, edges, alias_to_RANode, join_obtained, node)            
+                return _find_joins(node.left, edges, alias_to_RANode, join_obtained, node)
         else:
             child = getattr(node, 'child', None)
             if child:
-                _find_joins(child, edges, alias_to_RANode, join_obtained, node)
+                return _find_joins(child, edges, alias_to_RANode, join_obtained, node)
     
     if join_obtained == 1:
         edge = extract_tables(node.condition)
@@ -48,46 +49,174 @@ def _find_joins(node: RANode, edges: list[tuple[str,str,str]], alias_to_RANode:
         else:
             alias_to_RANode[node.right.get_alias()] = node.right
 
-def join_optimize(node: RANode) -> RANode:
-    # cost should be computed for RANode
+    return join_parent
+
+def _edge_rows(selectivity, left_rows, right_rows, profile):
+    if selectivity is None:
+        return max(50, left_rows * right_rows * (profile.join_selectivity if profile else 0.01))
+    return left_rows * right_rows * selectivity
+
+def _edge_cost(left_rows, right_rows, out_rows, profile):
+    if profile is None:
+        return out_rows
+    return profile.join_cost(left_rows, right_rows, out_rows)
+
+def _add_plan(frontier, plan):
+    """
+    Keep `frontier` the set of plans (cost, rows, ...) for one subset that no other plan beats
+    on both cost and output rows: a plan with fewer rows is never more expensive to extend.
+    Of two identical plans the first is kept. Returns the number of plans dropped.
+    """
+    cost, rows = plan[0], plan[1]
+    for kept in frontier:
+        if kept[0] <= cost and kept[1] <= rows:
+            return 1
+    before = len(frontier)
+    frontier[:] = [kept for kept in frontier if not (cost <= kept[0] and rows <= kept[1])]
+    frontier.append(plan)
+    return before - len(frontier) + 1
+
+def _expand_level(task):
+    """
+    Build the next level of the dynamic program from `level`, the connected subsets of k edges,
+    as {edge mask: (relation mask, frontier)} with frontier plans (cost, rows, edge, predecessor).
+    Each subset of k + 1 edges is built once, from all its predecessors, by whichever task owns
+    the predecessor missing its highest possible edge; this task owns the level's subsets
+    in positions start:stop, so tasks build disjoint parts of the next level.
+    Works on compact tables (bitmasks, edge endpoints as relation indices, row counts,
+    selectivities) so that it can run in a worker process; `level` may be passed pickled.
+    Returns the part of the next level built and the number of dominated plans dropped.
+    """
+    level, start, stop, edge_ends, rows, selectivities, profile = task
+    if isinstance(level, bytes):
+        level = pickle.loads(level)
+    n = len(edge_ends)
+    table = {}
+    dropped = 0
+    for mask in islice(level, start, stop):
+        visited = level[mask][0]
+        for i in range(n):
+            a, b = edge_ends[i]
+            if mask >> i & 1 or not (visited >> a & 1 or visited >> b & 1):
+                continue
+            target = mask | 1 << i
+            for j in range(n - 1, i, -1):
+                if target >> j & 1 and target ^ 1 << j in level:
+                    break
+            else:
+                frontier = []
+                for j in range(n):
+                    predecessor = level.get(target ^ 1 << j) if target >> j & 1 else None
+                    if predecessor is None:
+                        continue
+                    pred_visited, pred_frontier = predecessor
+                    a, b = edge_ends[j]
+                    other = b if pred_visited >> a & 1 else a
+                    for k, (cost, curr_rows, _, _) in enumerate(pred_frontier):
+                        out_rows = _edge_rows(selectivities[j], curr_rows, rows[other], profile)
+                        step_cost = _edge_cost(curr_rows, rows[other], out_rows, profile)
+                        dropped += _add_plan(frontier, (cost + step_cost, out_rows, j, k))
+                table[target] = (visited | 1 << edge_ends[i][0] | 1 << edge_ends[i][1], frontier)
+    return table, dropped
+
+def _dp_search(edge_ends, rows, selectivities, profile, parallel=None):
+    """
+    Cheapest left-deep order of the join edges, by dynamic programming over connected
+    subsets of edges, one level (subset size) at a time. Each subset keeps the plans not
+    beaten on both cost and output rows, and each plan links back to the plan it extends.
+    parallel: number of worker processes or an executor; levels with at least
+    PARALLEL_MIN_STATES subsets are pickled once and split across the workers, which
+    return disjoint parts of the next level.
+    Returns (cost, order, subsets, dropped).
+    """
+    n = len(edge_ends)
+    level = {}
+    for i, (a, b) in enumerate(edge_ends):
+        out_rows = _edge_rows(selectivities[i], rows[a], rows[b], profile)
+        level[1 << i] = (1 << a | 1 << b, [(_edge_cost(rows[a], rows[b], out_rows, profile), out_rows, i, None)])
+    levels = [level]
+    subsets, dropped = len(level), 0
+
+    executor, own_executor = parallel, False
+    if isinstance(parallel, int):
+        executor = None
+        if parallel > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            executor, own_executor = ProcessPoolExecutor(max_workers=parallel), True
+    workers = parallel if isinstance(parallel, int) else os.cpu_count() or 1
+    try:
+        for _ in range(n - 1):
+            if executor is not None and len(level) >= PARALLEL_MIN_STATES:
+                blob = pickle.dumps(level, protocol=pickle.HIGHEST_PROTOCOL)
+                size = -(-len(level) // workers)
+                tasks = [(blob, k, k + size, edge_ends, rows, selectivities, profile) for k in range(0, len(level), size)]
+                level = {}
+                for table, task_dropped in executor.map(_expand_level, tasks):
+                    level.update(table)
+                    dropped += task_dropped
+            else:
+                level, level_dropped = _expand_level((level, 0, len(level), edge_ends, rows, selectivities, profile))
+                dropped += level_dropped
+            levels.append(level)
+            subsets += len(level)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    full = level.get((1 << n) - 1)
+    if full is None:
+        return float('inf'), None, subsets, dropped
+    plans = full[1]
+    k = min(range(len(plans)), key=lambda k: plans[k][0])
+    cost = plans[k][0]
+    order, mask = [], (1 << n) - 1
+    for level in reversed(levels):
+        _, _, edge, k = level[mask][1][k]
+        order.append(edge)
+        mask ^= 1 << edge
+    return cost, order[::-1], subsets, dropped
+
+@metrics.timed('join_optimize')
+def join_optimize(node: RANode, feedback=None, profile=None, parallel=None) -> RANode:
+    """
+    Reorder the joins of the tree into the cheapest left-deep order.
+    parallel: number of worker processes, or a concurrent.futures executor to run on, for
+    splitting the large levels of the search across cores (see _dp_search).
+    """
+    # estimate_cost should have been run on node, so that every relation carries its row estimate
     edges = []
     alias_to_RANode = dict()
-    _find_joins(node, edges, alias_to_RANode, 0, node)
+    join_parent = _find_joins(node, edges, alias_to_RANode, 0, node)
     n = len(edges)+1
     if n < 2:
         return node
+
+    # look up learned join selectivities once per edge, outside the enumeration loop
+    selectivity = {}
+    for edge in edges:
+        learned = None
+        if feedback is not None:
+            tables = (alias_tables(alias_to_RANode[edge[0]]).get(edge[0], frozenset())
+                      | alias_tables(alias_to_RANode[edge[1]]).get(edge[1], frozenset()))
+            learned = feedback.lookup(edge[2], tables)
+        selectivity[edge] = learned
     
-    best_perm = []
-    best_cost = float('inf')
-    
-    for perm in permutations(edges):
-        valid = True
-        visited = set()
-        curr_cost = max(50,alias_to_RANode[perm[0][0]].cost * alias_to_RANode[perm[0][1]].cost* 0.01)
-        cumulative_cost = curr_cost
-        visited.add(perm[0][0])
-        visited.add(perm[0][1])
-        
-        for edge in perm[1:]:
-            if edge[0] in visited:
-                visited.add(edge[1])
-                curr_cost = max(50,curr_cost * alias_to_RANode[edge[1]].cost * 0.01)
-                cumulative_cost+=curr_cost
-            elif edge[1] in visited:
-                visited.add(edge[0])
-                curr_cost = max(50,curr_cost * alias_to_RANode[edge[0]].cost * 0.01)
-                cumulative_cost+=curr_cost
-            else:
-                valid = False
-                break
-        
-        if not valid:
-            continue
-        
-        if(cumulative_cost<best_cost):
-            best_perm = [edge for edge in perm]
-            best_cost = cumulative_cost
-    
+    # compact cost tables: relations and edges by index
+    aliases = list(alias_to_RANode)
+    index = {alias: i for i, alias in enumerate(aliases)}
+    edge_ends = [(index[edge[0]], index[edge[1]]) for edge in edges]
+    rows = [alias_to_RANode[alias].rows for alias in aliases]
+    selectivities = [selectivity[edge] for edge in edges]
+
+    best_cost, best_order, subsets, dropped = _dp_search(edge_ends, rows, selectivities, profile, parallel)
+
+    metrics.incr('join_subsets_enumerated', subsets)
+    metrics.incr('join_plans_pruned', dropped)
+    if best_order is None:
+        raise ValueError("The join conditions do not connect all relations")
+    best_perm = [edges[i] for i in best_order]
+
     curr = Join(alias_to_RANode[best_perm[0][0]], alias_to_RANode[best_perm[0][1]], best_perm[0][2])
     visited = set()
     visited.add(best_perm[0][0])
@@ -100,7 +229,7 @@ def join_optimize(node: RANode) -> RANode:
             visited.add(edge[0])
             curr = Join(curr, alias_to_RANode[edge[0]], edge[2])
     
-    temp_root.child = curr
+    join_parent.child = curr
     return node
     
     
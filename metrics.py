@@ -0,0 +1,305 @@
+import contextvars
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from file_store import private_dir, atomic_write
+
+# Worker processes of a multi-process server publish their aggregates here, one file per pid
+DEFAULT_METRICS_DIR = os.path.join(tempfile.gettempdir(), 'optiquery_metrics')
+
+# Metrics of the request being served in this thread/context; None outside a request
+_current = contextvars.ContextVar('optiquery_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Phase timings (seconds) and counters collected while serving one request."""
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counters = Counter()
+
+    def to_dict(self):
+        return {
+            'timings_ms': {phase: round(seconds * 1000, 3) for phase, seconds in self.timings.items()},
+            'counters': dict(self.counters),
+        }
+
+    def server_timing(self):
+        """Value for the Server-Timing response header."""
+        return ', '.join(f"{phase};dur={seconds * 1000:.3f}" for phase, seconds in self.timings.items())
+
+
+def begin_request():
+    metrics = RequestMetrics()
+    _current.set(metrics)
+    return metrics
+
+
+def end_request():
+    metrics = _current.get()
+    _current.set(None)
+    return metrics
+
+
+def current():
+    return _current.get()
+
+
+def incr(name: str, amount=1):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.counters[name] += amount
+
+
+@contextmanager
+def timer(phase: str):
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timings[phase] += time.perf_counter() - start
+
+
+def timed(phase: str):
+    """Decorator form of timer()."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _write_snapshot(directory: str, kind: str, data: dict):
+    atomic_write(os.path.join(private_dir(directory), f"{kind}-{os.getpid()}.json"), json.dumps(data))
+
+
+def _read_snapshots(directory: str, kind: str):
+    """Snapshots published by the other live processes; those of exited processes are removed."""
+    own_pid = os.getpid()
+    for name in os.listdir(private_dir(directory)):
+        match = re.fullmatch(rf"{kind}-(\d+)\.json", name)
+        if match is None or int(match.group(1)) == own_pid:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if not _pid_alive(int(match.group(1))):
+                os.remove(path)
+                continue
+            with open(path) as f:
+                yield json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+
+
+class MetricsRegistry:
+    """
+    Process-wide aggregate of request metrics, rendered in the Prometheus text format.
+    Counters named <cache>_hits / <cache>_misses also get a <cache>_hit_ratio gauge.
+
+    With a directory, a background thread publishes this process's aggregate there every
+    flush_interval seconds and render_prometheus() sums those of all live processes, so
+    any worker answers a scrape with the totals of the whole server.
+    """
+
+    def __init__(self, prefix='optiquery', directory=None, flush_interval=1.0):
+        self.prefix = prefix
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._phase_seconds = defaultdict(float)
+        self._phase_count = Counter()
+        self._counters = Counter()
+        self._requests = Counter()
+        self._dirty = False
+        self._flusher = None
+        self._lock = threading.Lock()
+
+    def record(self, metrics: RequestMetrics, endpoint: str):
+        with self._lock:
+            self._requests[endpoint or 'unknown'] += 1
+            for phase, seconds in metrics.timings.items():
+                self._phase_seconds[phase] += seconds
+                self._phase_count[phase] += 1
+            self._counters.update(metrics.counters)
+            self._dirty = True
+            # started on first use, i.e. in the worker process after any fork
+            start_flusher = self.directory is not None and self._flusher is None
+            if start_flusher:
+                self._flusher = threading.Thread(target=self._flush_loop, name='optiquery-metrics-flusher', daemon=True)
+        if start_flusher:
+            self._flusher.start()
+
+    def _snapshot(self):
+        return {
+            'requests': dict(self._requests),
+            'phase_seconds': dict(self._phase_seconds),
+            'phase_count': dict(self._phase_count),
+            'counters': dict(self._counters),
+        }
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = self._snapshot()
+            self._dirty = False
+        _write_snapshot(self.directory, 'registry', snapshot)
+
+    def render_prometheus(self):
+        with self._lock:
+            snapshots = [self._snapshot()]
+        if self.directory is not None:
+            snapshots.extend(_read_snapshots(self.directory, 'registry'))
+        requests, phase_seconds, phase_count, counters = Counter(), Counter(), Counter(), Counter()
+        for snapshot in snapshots:
+            requests.update(snapshot['requests'])
+            phase_seconds.update(snapshot['phase_seconds'])
+            phase_count.update(snapshot['phase_count'])
+            counters.update(snapshot['counters'])
+
+        p = self.prefix
+        lines = [f"# TYPE {p}_requests_total counter"]
+        for endpoint, count in sorted(requests.items()):
+            lines.append(f'{p}_requests_total{{endpoint="{endpoint}"}} {count}')
+
+        lines.append(f"# TYPE {p}_phase_seconds summary")
+        for phase in sorted(phase_seconds):
+            lines.append(f'{p}_phase_seconds_sum{{phase="{phase}"}} {phase_seconds[phase]:.6f}')
+            lines.append(f'{p}_phase_seconds_count{{phase="{phase}"}} {phase_count[phase]}')
+
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            lines.append(f"{p}_{name}_total {value}")
+
+        caches = sorted({name[:-len('_hits')] for name in counters if name.endswith('_hits')}
+                        | {name[:-len('_misses')] for name in counters if name.endswith('_misses')})
+        for cache in caches:
+            hits, misses = counters[f"{cache}_hits"], counters[f"{cache}_misses"]
+            lines.append(f"# TYPE {p}_{cache}_hit_ratio gauge")
+            lines.append(f"{p}_{cache}_hit_ratio {hits / (hits + misses) if hits + misses else 0:.6f}")
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """
+    Opt-in statistical profiler: a daemon thread samples the stacks of all other threads
+    every `interval` seconds and counts them in folded-stack format (one line per stack,
+    frames separated by ';'), ready for flamegraph tools.
+
+    With a directory, the counts are published there every flush_interval seconds and
+    folded() merges those of all live processes; reset() clears them in every process.
+    """
+
+    def __init__(self, interval=0.005, max_depth=64, directory=None, flush_interval=1.0):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._stacks = Counter()
+        self._reset_at = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='optiquery-sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        next_flush = time.monotonic() + self.flush_interval
+        while not self._stop.wait(self.interval):
+            samples = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                    frame = frame.f_back
+                samples.append(';'.join(reversed(stack)))
+            with self._lock:
+                self._stacks.update(samples)
+            if self.directory is not None and time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + self.flush_interval
+
+    def _reset_marker(self):
+        return os.path.join(self.directory, 'profile.reset')
+
+    def _flush(self):
+        try:
+            reset_at = os.path.getmtime(self._reset_marker())
+        except FileNotFoundError:
+            reset_at = 0
+        with self._lock:
+            if reset_at > self._reset_at:
+                self._stacks.clear()
+                self._reset_at = reset_at
+            stacks = dict(self._stacks)
+        _write_snapshot(self.directory, 'profile', stacks)
+
+    def folded(self):
+        with self._lock:
+            stacks = Counter(self._stacks)
+        if self.directory is not None:
+            for snapshot in _read_snapshots(self.directory, 'profile'):
+                stacks.update(snapshot)
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def reset(self):
+        reset_at = time.time()
+        if self.directory is not None:
+            # other processes clear their counts when they next see the marker
+            private_dir(self.directory)
+            with open(self._reset_marker(), 'w'):
+                pass
+            reset_at = os.path.getmtime(self._reset_marker())
+            for name in os.listdir(self.directory):
+                if name.startswith('profile-'):
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        pass
+        with self._lock:
+            self._stacks.clear()
+            self._reset_at = reset_at
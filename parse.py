@@ -1,7 +1,6 @@
-import sqlglot
-from sqlglot import expressions as exp
-from graphviz import Digraph
-import uuid
+# sqlglot and graphviz are imported where they are used, so that importing the RA classes
+# (e.g. to cost or reorder a stored tree) stays cheap and graphviz stays optional
+import metrics
 
 COLOR_MAP = {
     'Relation': '#AED6F1',    # light blue
@@ -11,14 +10,19 @@ COLOR_MAP = {
     'Subquery': '#D7BDE2',    # light purple
 }
 
+# Attributes set by estimate_cost, kept when a tree is converted to plain data
+_ESTIMATES = ('rows', 'cost', 'cumulative_cost')
+
 # Define basic RA node classes
 class RANode:
-    def to_dot(self, dot=None, parent_id=None):
+    def to_dot(self, dot=None, parent_id=None, node_id='n0'):
+        # Node ids follow the path from the root (n0, n0_0, n0_1, ...) so identical plans give identical DOT
         if dot is None:
+            from graphviz import Digraph
+
             dot = Digraph()
             dot.attr(rankdir='BT')  # Bottom-to-top layout
 
-        node_id = str(uuid.uuid4())
         node_type = self.__class__.__name__
         fillcolor = COLOR_MAP.get(node_type, '#ffffff')
 
@@ -37,22 +41,35 @@ class RANode:
 
         # Recursively process children
         if hasattr(self, 'child'):
-            self.child.to_dot(dot, node_id)
+            self.child.to_dot(dot, node_id, f"{node_id}_0")
         if hasattr(self, 'left'):
-            self.left.to_dot(dot, node_id)
+            self.left.to_dot(dot, node_id, f"{node_id}_0")
         if hasattr(self, 'right'):
-            self.right.to_dot(dot, node_id)
+            self.right.to_dot(dot, node_id, f"{node_id}_1")
 
         return dot
 
     def get_alias(self):
         pass
 
+    def to_dict(self) -> dict:
+        """Plain-data form of the tree, with any cost estimates, e.g. to store it as JSON."""
+        data = {'type': self.__class__.__name__}
+        for field in self._fields:
+            value = getattr(self, field)
+            data[field] = value.to_dict() if isinstance(value, RANode) else value
+        for estimate in _ESTIMATES:
+            if hasattr(self, estimate):
+                data[estimate] = getattr(self, estimate)
+        return data
+
     def __repr__(self):
         return self.__str__()
 
 
 class Relation(RANode):
+    _fields = ('table_name', 'alias')
+
     def __init__(self, table_name, alias=None):
         self.table_name = table_name
         self.alias = alias
@@ -77,6 +94,8 @@ class Relation(RANode):
 
 
 class Selection(RANode):
+    _fields = ('condition', 'child')
+
     def __init__(self, condition, child):
         self.condition = condition
         self.child = child
@@ -98,6 +117,8 @@ class Selection(RANode):
 
 
 class Projection(RANode):
+    _fields = ('columns', 'child')
+
     def __init__(self, columns, child):
         self.columns = columns
         self.child = child
@@ -121,6 +142,8 @@ class Projection(RANode):
 
 
 class Join(RANode):
+    _fields = ('left', 'right', 'condition')
+
     def __init__(self, left, right, condition):
         self.left = left
         self.right = right
@@ -140,6 +163,8 @@ class Join(RANode):
 
 
 class Subquery(RANode):
+    _fields = ('alias', 'child')
+
     def __init__(self, alias, child):
         self.alias = alias
         self.child = child
@@ -159,8 +184,26 @@ class Subquery(RANode):
         return f'Subquery("{self.alias}", {self.child})'
 
 
+NODE_TYPES = {cls.__name__: cls for cls in (Relation, Selection, Projection, Join, Subquery)}
+
+
+def node_from_dict(data: dict) -> RANode:
+    """Rebuild a tree from RANode.to_dict(); raises KeyError or TypeError on malformed data."""
+    cls = NODE_TYPES[data['type']]
+    node = cls.__new__(cls)
+    for field in cls._fields:
+        value = data[field]
+        setattr(node, field, node_from_dict(value) if isinstance(value, dict) else value)
+    for estimate in _ESTIMATES:
+        if estimate in data:
+            setattr(node, estimate, data[estimate])
+    return node
+
+
 # Helper function to build a Relation or Subquery node from a table, alias, or subquery node
 def build_table(node):
+    from sqlglot import expressions as exp
+
     # Direct table reference, preserve alias if present
     if isinstance(node, exp.Table):
         table_name = node.this.name
@@ -193,7 +236,10 @@ def build_table(node):
 
 # Main function to construct the RA tree from a SQL query (handling subqueries)
 def build_ra_tree(query):
-    ast = sqlglot.parse_one(query)
+    import sqlglot
+
+    with metrics.timer('sqlglot_parse'):
+        ast = sqlglot.parse_one(query)
     from_expr = ast.args.get("from")
     if not from_expr:
         raise ValueError("No FROM clause found in query")
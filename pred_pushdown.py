@@ -1,8 +1,8 @@
-from graphviz import Digraph
-import uuid
 from parse import RANode, Relation, Selection, Projection, Join, Subquery, COLOR_MAP
 import re
 
+from cardinality_feedback import split_conjuncts
+
 def extract_columns(condition: str):
     """Roughly extract identifiers like sq.a, t1.b from condition."""
     tokens = condition.replace('=', ' ').replace('<', ' ').replace('>', ' ').replace('<=', ' ').replace('>=', ' ').split()
@@ -58,8 +58,8 @@ def pushdown_selections(node: RANode) -> RANode:
         if cond.upper().startswith("WHERE "):
             cond = cond[6:].strip()
         child = pushdown_selections(node.child)
-        if re.search(r'\bAND\b', cond, flags=re.IGNORECASE):
-            parts = [part.strip() for part in re.split(r'\bAND\b', cond, flags=re.IGNORECASE)]
+        parts = split_conjuncts(cond)
+        if len(parts) > 1:
             result = node.child
             for part in parts:
                 result = pushdown_selections(Selection("WHERE " + part, result))
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from parse import RANode
+from file_store import private_dir, atomic_write, evict_older_than, PeriodicSweep
+import metrics
+
+DEFAULT_GRAPH_DIR = os.path.join(tempfile.gettempdir(), 'optiquery_graphs')
+
+
+def plan_key(node: RANode) -> tuple:
+    """Structural key of a plan: node types and labels (including costs), in tree order."""
+    children = tuple(
+        plan_key(getattr(node, attr)) for attr in ('child', 'left', 'right') if hasattr(node, attr)
+    )
+    return node.__class__.__name__, node._dot_label(), children
+
+
+def content_etag(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:32]
+
+
+class RenderCache:
+    """
+    Content-addressed cache of rendered graphs. DOT sources are stored under the hash of
+    their text (which doubles as the HTTP ETag); SVGs are rendered from them at most once.
+    Plans are mapped to their DOT source by structural key, so re-rendering an unchanged
+    plan skips DOT generation entirely. Both maps are bounded LRUs.
+
+    DOT sources are also written to `directory` as <etag>.dot, so a /graph/<etag> URL
+    issued by one worker process can be served by any other; `directory` must be private
+    (see file_store.private_dir). Files untouched for
+    max_age seconds are discarded every evict_every writes.
+    """
+
+    def __init__(self, max_entries=256, directory=DEFAULT_GRAPH_DIR, max_age=24 * 3600, evict_every=100):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_age = max_age
+        self._sweep = PeriodicSweep(directory, max_age, evict_every)
+        self._plans = OrderedDict()      # plan_key -> etag
+        self._dot = OrderedDict()        # etag -> DOT source
+        self._svg = OrderedDict()        # etag -> SVG bytes
+        self._expiring = {}              # name -> (etag, payload, expires_at)
+        self._lock = threading.Lock()
+
+    def _remember(self, table: OrderedDict, key, value):
+        table[key] = value
+        table.move_to_end(key)
+        while len(table) > self.max_entries:
+            table.popitem(last=False)
+
+    def _path(self, etag: str):
+        # etags come from the URL; never let them escape the graph directory
+        if not etag or not etag.isalnum():
+            return None
+        return os.path.join(self.directory, f"{etag}.dot")
+
+    def put_dot(self, dot_src: str) -> str:
+        etag = content_etag(dot_src)
+        with self._lock:
+            self._remember(self._dot, etag, dot_src)
+        private_dir(self.directory)
+        path = self._path(etag)
+        if os.path.exists(path):
+            os.utime(path)
+            return etag
+        atomic_write(path, dot_src)
+        self._sweep.tick()
+        return etag
+
+    def get_dot(self, etag: str):
+        with self._lock:
+            dot_src = self._dot.get(etag)
+            if dot_src is not None:
+                self._dot.move_to_end(etag)
+                return dot_src
+        path = self._path(etag)
+        if path is None:
+            return None
+        private_dir(self.directory)
+        try:
+            with open(path) as f:
+                dot_src = f.read()
+        except FileNotFoundError:
+            return None
+        metrics.incr('dot_disk_reads')
+        with self._lock:
+            self._remember(self._dot, etag, dot_src)
+        return dot_src
+
+    def evict_stale(self):
+        evict_older_than(private_dir(self.directory), self.max_age)
+
+    def plan_dot(self, ra_root: RANode):
+        """DOT source of an (already cost-annotated) plan and its ETag."""
+        key = plan_key(ra_root)
+        with self._lock:
+            etag = self._plans.get(key)
+            if etag is not None and etag in self._dot:
+                self._plans.move_to_end(key)
+                self._dot.move_to_end(etag)
+                metrics.incr('render_cache_hits')
+                return etag, self._dot[etag]
+
+        metrics.incr('render_cache_misses')
+        with metrics.timer('dot_generation'):
+            dot_src = ra_root.to_dot().source
+        etag = self.put_dot(dot_src)
+        with self._lock:
+            self._remember(self._plans, key, etag)
+        return etag, dot_src
+
+    def svg(self, etag: str):
+        """SVG for a cached DOT source, rendered with the graphviz binary on first use."""
+        with self._lock:
+            svg = self._svg.get(etag)
+            if svg is not None:
+                self._svg.move_to_end(etag)
+                metrics.incr('svg_cache_hits')
+                return svg
+        dot_src = self.get_dot(etag)
+        if dot_src is None:
+            return None
+
+        from graphviz import Source
+
+        metrics.incr('svg_cache_misses')
+        with metrics.timer('svg_render'):
+            svg = Source(dot_src).pipe(format='svg')
+        with self._lock:
+            self._remember(self._svg, etag, svg)
+        return svg
+
+    def get_expiring(self, name: str):
+        """ETag and payload last stored under name, or (None, None) once its ttl has passed."""
+        with self._lock:
+            entry = self._expiring.get(name)
+            if entry is None or entry[2] < time.time():
+                metrics.incr(f"{name}_cache_misses")
+                return None, None
+            metrics.incr(f"{name}_cache_hits")
+            return entry[0], entry[1]
+
+    def put_expiring(self, name: str, payload: dict, ttl: float) -> str:
+        """Store a payload that cannot be keyed by content up front (e.g. the live schema graph)."""
+        etag = content_etag(json.dumps(payload, sort_keys=True))
+        with self._lock:
+            self._expiring[name] = (etag, payload, time.time() + ttl)
+        return etag
@@ -0,0 +1,309 @@
+import csv
+import datetime
+import operator
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+from cardinality_feedback import normalize_predicate, strip_where
+import metrics
+
+_INT_RE = re.compile(r'^-?\d+$')
+_DECIMAL_RE = re.compile(r'^-?\d+\.\d+$')
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def _coerce(value: str):
+    """Give CSV sample values the Python types the database driver would have returned."""
+    if _INT_RE.match(value):
+        return int(value)
+    if _DECIMAL_RE.match(value):
+        return Decimal(value)
+    if _DATE_RE.match(value):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+class _Unsupported(Exception):
+    """Raised for expressions the column-wise evaluator cannot handle."""
+
+
+_COMPARISONS = {'EQ': operator.eq, 'NEQ': operator.ne, 'GT': operator.gt, 'GTE': operator.ge,
+                'LT': operator.lt, 'LTE': operator.le}
+_ARITHMETIC = {'Add': operator.add, 'Sub': operator.sub, 'Mul': operator.mul, 'Div': operator.truediv}
+
+
+def _like_regex(pattern: str, flags=0):
+    regex = ''.join('.*' if ch == '%' else '.' if ch == '_' else re.escape(ch) for ch in pattern)
+    return re.compile(regex, flags | re.DOTALL)
+
+
+def _literal(node, n: int) -> list:
+    if node.is_string:
+        return [node.this] * n
+    try:
+        return [int(node.this)] * n
+    except ValueError:
+        try:
+            return [Decimal(node.this)] * n
+        except InvalidOperation:
+            raise _Unsupported(node.sql())
+
+
+def _evaluate_columns(node, columns: dict, n: int, names: set) -> list:
+    """
+    Value of a sqlglot expression for every sampled row, computed one operator at a time over
+    whole columns (plain Python lists, not SIMD). NULL is None, with SQL's three-valued logic.
+    Nodes are matched by class name so that sqlglot is only imported when a predicate is evaluated.
+    """
+    kind = type(node).__name__
+    if kind == 'Paren':
+        return _evaluate_columns(node.this, columns, n, names)
+    if kind == 'Column':
+        if node.table and node.table.lower() not in names or node.name.lower() not in columns:
+            raise _Unsupported(node.sql())
+        return columns[node.name.lower()]
+    if kind == 'Literal':
+        return _literal(node, n)
+    if kind == 'Null':
+        return [None] * n
+    if kind == 'Boolean':
+        return [node.this] * n
+    if kind == 'Cast':
+        values = _evaluate_columns(node.this, columns, n, names)
+        target = node.to.sql().upper()
+        if target == 'DATE':
+            return [datetime.date.fromisoformat(v) if isinstance(v, str) else v for v in values]
+        if target in ('INT', 'BIGINT', 'INTEGER'):
+            return [None if v is None else int(v) for v in values]
+        if target.startswith(('DECIMAL', 'NUMERIC')):
+            return [None if v is None else Decimal(str(v)) for v in values]
+        raise _Unsupported(node.sql())
+    if kind in _COMPARISONS or kind in _ARITHMETIC:
+        op = _COMPARISONS.get(kind) or _ARITHMETIC[kind]
+        left = _evaluate_columns(node.this, columns, n, names)
+        right = _evaluate_columns(node.expression, columns, n, names)
+        try:
+            return [None if a is None or b is None else op(a, b) for a, b in zip(left, right)]
+        except (TypeError, ArithmeticError):
+            raise _Unsupported(node.sql())
+    if kind == 'Neg':
+        return [None if v is None else -v for v in _evaluate_columns(node.this, columns, n, names)]
+    if kind == 'And':
+        left = _evaluate_columns(node.this, columns, n, names)
+        right = _evaluate_columns(node.expression, columns, n, names)
+        return [False if a is False or b is False else None if a is None or b is None else True
+                for a, b in zip(left, right)]
+    if kind == 'Or':
+        left = _evaluate_columns(node.this, columns, n, names)
+        right = _evaluate_columns(node.expression, columns, n, names)
+        return [True if a is True or b is True else None if a is None or b is None else False
+                for a, b in zip(left, right)]
+    if kind == 'Not':
+        return [None if v is None else not v for v in _evaluate_columns(node.this, columns, n, names)]
+    if kind in ('Like', 'ILike'):
+        if type(node.expression).__name__ != 'Literal' or not node.expression.is_string:
+            raise _Unsupported(node.sql())
+        regex = _like_regex(node.expression.this, re.IGNORECASE if kind == 'ILike' else 0)
+        values = _evaluate_columns(node.this, columns, n, names)
+        return [None if v is None else regex.fullmatch(str(v)) is not None for v in values]
+    if kind == 'Is' and type(node.expression).__name__ == 'Null':
+        return [v is None for v in _evaluate_columns(node.this, columns, n, names)]
+    if kind == 'In' and node.expressions and not node.args.get('query'):
+        if not all(type(item).__name__ in ('Literal', 'Null') for item in node.expressions):
+            raise _Unsupported(node.sql())
+        values = _evaluate_columns(node.this, columns, n, names)
+        items = {_evaluate_columns(item, columns, 1, names)[0] for item in node.expressions}
+        return [None if v is None else v in items for v in values]
+    if kind == 'Between':
+        values = _evaluate_columns(node.this, columns, n, names)
+        low = _evaluate_columns(node.args['low'], columns, n, names)
+        high = _evaluate_columns(node.args['high'], columns, n, names)
+        try:
+            return [None if v is None or a is None or b is None else a <= v <= b
+                    for v, a, b in zip(values, low, high)]
+        except TypeError:
+            raise _Unsupported(node.sql())
+    raise _Unsupported(node.sql())
+
+
+class SamplingEstimator:
+    """
+    Estimates selectivities of single-table predicates that catalog statistics cannot
+    handle (LIKE '%green%', correlated multi-column filters, ...) by evaluating them on a
+    cached row sample of the table.
+
+    The sample for each table is taken once, either from <sample_dir>/<table>.csv or
+    from the database with TABLESAMPLE SYSTEM through the connect callable; a failed fetch is
+    retried after retry_after seconds. Each predicate is evaluated column-wise over the whole
+    sample; predicates the column-wise evaluator does not support fall back to sqlglot's row-at-a-time
+    executor over batches of the sample, stopping at time_limit seconds and using the rows
+    evaluated so far. The last max_estimates results are memoized per (table, predicate).
+    """
+
+    def __init__(self, connect=None, sample_dir=None, sample_size=2000, batch_size=500, time_limit=0.5, seed=315,
+                 max_estimates=4096, retry_after=300):
+        self.connect = connect
+        self.sample_dir = sample_dir
+        self.sample_size = sample_size
+        self.batch_size = batch_size
+        self.time_limit = time_limit
+        self.seed = seed
+        self.max_estimates = max_estimates
+        self.retry_after = retry_after
+        self._samples = {}                # table -> list of row dicts
+        self._columns = {}                # table -> column name -> list of values
+        self._failed = {}                 # table -> time of the last failed fetch
+        self._estimates = OrderedDict()   # (table, normalized predicate) -> selectivity or None
+        self._lock = threading.Lock()
+
+    def sample(self, table: str) -> list:
+        """Sampled rows of the table; empty if none could be taken (retried after retry_after)."""
+        table = table.lower()
+        with self._lock:
+            if table in self._samples:
+                return self._samples[table]
+            if time.time() - self._failed.get(table, float('-inf')) < self.retry_after:
+                return []
+        with metrics.timer('sample_fetch'):
+            rows = self._load_sample_file(table)
+            if rows is None and self.connect is not None:
+                rows = self._fetch_tablesample(table)
+        with self._lock:
+            if rows is None:
+                self._failed[table] = time.time()
+                return []
+            self._failed.pop(table, None)
+            self._samples.setdefault(table, rows)
+            return self._samples[table]
+
+    def columns(self, table: str) -> dict:
+        """The sample of the table as column name -> list of values."""
+        rows = self.sample(table)
+        with self._lock:
+            if table.lower() in self._columns:
+                return self._columns[table.lower()]
+        columns = {name: [row.get(name) for row in rows] for name in (rows[0] if rows else ())}
+        with self._lock:
+            if rows:
+                self._columns.setdefault(table.lower(), columns)
+            return columns
+
+    def _load_sample_file(self, table: str):
+        if self.sample_dir is None:
+            return None
+        path = os.path.join(self.sample_dir, f"{table}.csv")
+        if not os.path.exists(path):
+            return None
+        with open(path, newline='') as f:
+            reader = csv.DictReader(f)
+            rows = []
+            for row in reader:
+                rows.append({col.lower(): _coerce(val) for col, val in row.items()})
+                if len(rows) >= self.sample_size:
+                    break
+        return rows
+
+    def _fetch_tablesample(self, table: str):
+        """
+        Block sample of the table, or None if it cannot be taken in time_limit seconds.
+        """
+        conn = cursor = None
+        try:
+            from psycopg2 import sql
+
+            conn = self.connect()
+            cursor = conn.cursor()
+            cursor.execute("SET LOCAL statement_timeout = %s", (max(1, int(self.time_limit * 1000)),))
+            cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", (table,))
+            result = cursor.fetchone()
+            if result is None:
+                return None
+            reltuples = max(1.0, float(result[0]))
+            percent = min(100.0, 100.0 * 2 * self.sample_size / reltuples)
+            # SYSTEM reads whole random pages instead of scanning the table like BERNOULLI
+            cursor.execute(
+                sql.SQL("SELECT * FROM {} TABLESAMPLE SYSTEM (%s) REPEATABLE (%s) LIMIT %s").format(sql.Identifier(table)),
+                (percent, self.seed, self.sample_size)
+            )
+            columns = [desc[0].lower() for desc in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"Error sampling table {table}: {e}")
+            return None
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if conn is not None:
+                conn.close()
+
+    def selectivity(self, table: str, alias: str, condition: str):
+        """
+        Fraction of sampled rows of `table` (referenced as `alias` in condition) that satisfy it.
+        Returns None when no sample is available or the predicate cannot be evaluated.
+        """
+        key = (table.lower(), normalize_predicate(condition))
+        with self._lock:
+            if key in self._estimates:
+                self._estimates.move_to_end(key)
+                metrics.incr('sample_estimate_cache_hits')
+                return self._estimates[key]
+
+        metrics.incr('sample_estimate_cache_misses')
+        # not memoized: the sample may become available later
+        if not self.sample(table):
+            return None
+        with metrics.timer('sample_estimate'):
+            estimate = self._evaluate(table.lower(), alias, condition)
+        with self._lock:
+            self._estimates[key] = estimate
+            self._estimates.move_to_end(key)
+            while len(self._estimates) > self.max_estimates:
+                self._estimates.popitem(last=False)
+        return estimate
+
+    def _evaluate(self, table: str, alias: str, condition: str):
+        import sqlglot
+
+        rows = self.sample(table)
+        if not rows:
+            return None
+
+        cond = strip_where(condition)
+        try:
+            matches = _evaluate_columns(sqlglot.parse_one(cond), self.columns(table), len(rows),
+                                        {table, alias.lower()})
+            matched = sum(1 for match in matches if match is True)
+            return max(matched, 1) / len(rows)
+        except _Unsupported:
+            metrics.incr('sample_estimate_fallbacks')
+        except Exception as e:
+            print(f"Error evaluating {cond!r} on sample of {table}: {e}")
+            return None
+        return self._execute(table, alias, cond, rows)
+
+    def _execute(self, table: str, alias: str, cond: str, rows: list):
+        """Evaluate with sqlglot's executor, which interprets the predicate row by row."""
+        from sqlglot.executor import execute
+
+        query = f"SELECT COUNT(*) AS n FROM {table} AS {alias} WHERE {cond}"
+
+        deadline = time.perf_counter() + self.time_limit
+        matched = 0
+        evaluated = 0
+        try:
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                matched += execute(query, tables={table: batch}).rows[0][0]
+                evaluated += len(batch)
+                if time.perf_counter() > deadline:
+                    break
+        except Exception as e:
+            print(f"Error evaluating {cond!r} on sample of {table}: {e}")
+            return None
+
+        # no sampled match means the predicate is rare, not that it never matches
+        return max(matched, 1) / evaluated
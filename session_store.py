@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from file_store import private_dir, atomic_write, evict_older_than, PeriodicSweep
+
+DEFAULT_SESSION_DIR = os.path.join(tempfile.gettempdir(), 'optiquery_sessions')
+
+
+class SessionStore:
+    """
+    Server-side storage for per-session optimizer state (the working RA tree and the
+    table statistics it was costed with), as JSON-serializable dicts. Each session is a JSON
+    file in `directory` (a private directory, see file_store.private_dir), written atomically, so every worker thread or process of the WSGI server sees the
+    same state for a session. Sessions untouched for max_age seconds are discarded,
+    on load and by a sweep of the directory every evict_every saves.
+    """
+
+    def __init__(self, directory=DEFAULT_SESSION_DIR, max_age=24 * 3600, evict_every=100):
+        self.directory = directory
+        self.max_age = max_age
+        self._sweep = PeriodicSweep(directory, max_age, evict_every)
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def valid_id(self, session_id: str) -> bool:
+        return self._path(session_id) is not None
+
+    def _path(self, session_id: str):
+        # session ids come from a cookie; never let them escape the session directory
+        if not session_id or not session_id.isalnum():
+            return None
+        return os.path.join(self.directory, f"{session_id}.json")
+
+    def load(self, session_id: str) -> dict:
+        path = self._path(session_id)
+        if path is None:
+            return {}
+        private_dir(self.directory)
+        if not os.path.exists(path):
+            return {}
+        if time.time() - os.path.getmtime(path) > self.max_age:
+            self.delete(session_id)
+            return {}
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if not isinstance(state, dict):
+                raise ValueError("not a JSON object")
+            return state
+        except Exception as e:
+            # a session that cannot be read is treated as a new, empty one
+            print(f"Error loading session {session_id}: {e}")
+            return {}
+
+    def save(self, session_id: str, state: dict):
+        path = self._path(session_id)
+        if path is None:
+            return
+        private_dir(self.directory)
+        atomic_write(path, json.dumps(state))
+        self._sweep.tick()
+
+    def delete(self, session_id: str):
+        path = self._path(session_id)
+        if path is not None and os.path.exists(path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict_stale(self):
+        evict_older_than(private_dir(self.directory), self.max_age)
@@ -0,0 +1,111 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cardinality_feedback import CardinalityFeedback, normalize_predicate, split_conjuncts
+from cost_estimator import estimate_cost
+from parse import Relation, Selection, Join
+from pred_pushdown import pushdown_selections
+
+
+@pytest.mark.parametrize('sqlglot, explain', [
+    ("WHERE p.p_type LIKE '%BRASS'", "((p_type)::text ~~ '%BRASS'::text)"),
+    ("WHERE p.p_type NOT LIKE '%BRASS'", "((p_type)::text !~~ '%BRASS'::text)"),
+    ("WHERE c.c_name ILIKE 'a%'", "((c_name)::text ~~* 'a%'::text)"),
+    ("WHERE l.l_shipmode IN ('SHIP', 'MAIL')", "(l_shipmode = ANY ('{MAIL,SHIP}'::bpchar[]))"),
+    ("WHERE l.l_shipmode IN ('AIR', 'AIR REG')", "(l_shipmode = ANY ('{AIR,\"AIR REG\"}'::bpchar[]))"),
+    ("WHERE o.o_orderkey IN (3, 1, 2)", "(o_orderkey = ANY ('{1,2,3}'::integer[]))"),
+    ("WHERE o.o_orderkey NOT IN (1, 2)", "(o_orderkey <> ALL ('{1,2}'::integer[]))"),
+    ("WHERE l.l_discount BETWEEN 0.05 AND 0.07", "((l_discount >= 0.05) AND (l_discount <= 0.07))"),
+    ("WHERE l.l_quantity < 24", "(l_quantity < '24'::numeric)"),
+    ("WHERE o.o_orderdate >= CAST('1994-01-01' AS DATE)", "(o_orderdate >= '1994-01-01'::date)"),
+    ("o.o_custkey = c.c_custkey", "(c.c_custkey = o.o_custkey)"),
+    # EXPLAIN reports every filter of a scan as one conjunction, in its own order
+    ("WHERE l.l_quantity < 24 AND l.l_shipmode IN ('MAIL', 'SHIP')",
+     "((l_shipmode = ANY ('{MAIL,SHIP}'::bpchar[])) AND (l_quantity < '24'::numeric))"),
+    ("WHERE (n.n_name = 'FRANCE' OR n.n_name = 'GERMANY') AND n.n_regionkey = 3",
+     "(((n_name = 'FRANCE'::bpchar) OR (n_name = 'GERMANY'::bpchar)) AND (n_regionkey = 3))"),
+])
+def test_normalize_matches_explain(sqlglot, explain):
+    assert normalize_predicate(sqlglot) == normalize_predicate(explain)
+
+
+@pytest.mark.parametrize('a, b', [
+    ("WHERE l.l_quantity < 24", "WHERE l.l_quantity > 24"),
+    ("WHERE p.p_type LIKE '%BRASS'", "WHERE p.p_type NOT LIKE '%BRASS'"),
+    ("WHERE n.n_name = 'FRANCE' OR n.n_regionkey = 3", "WHERE n.n_name = 'FRANCE' AND n.n_regionkey = 3"),
+    ("WHERE c.c_name = 'A AND B'", "WHERE c.c_name = 'a and b'"),
+])
+def test_normalize_keeps_different_predicates_apart(a, b):
+    assert normalize_predicate(a) != normalize_predicate(b)
+
+
+def test_split_conjuncts():
+    assert split_conjuncts("WHERE a = 1 AND (b = 2 OR c = 3)") == ["a = 1", "b = 2 OR c = 3"]
+    assert split_conjuncts("x BETWEEN 1 AND 2 AND y = 'p AND q'") == ["x BETWEEN 1 AND 2", "y = 'p AND q'"]
+    assert split_conjuncts("((a) AND ((b) AND (c)))") == ["a", "b", "c"]
+    assert split_conjuncts("(a AND b) OR c") == ["(a AND b) OR c"]
+
+
+def test_pushdown_keeps_between_whole():
+    tree = Selection("WHERE l.l_discount BETWEEN 0.05 AND 0.07 AND l.l_quantity < 24", Relation("lineitem", "l"))
+    pushed = pushdown_selections(tree)
+    assert {pushed.condition, pushed.child.condition} == {
+        "WHERE l.l_discount BETWEEN 0.05 AND 0.07", "WHERE l.l_quantity < 24"}
+
+
+def explain_scan(table, alias, condition, rows, removed, loops=1):
+    return {'Node Type': 'Seq Scan', 'Relation Name': table, 'Alias': alias, 'Filter': condition,
+            'Actual Rows': rows, 'Actual Loops': loops, 'Rows Removed by Filter': removed}
+
+
+def test_learn_scan_filter(tmp_path):
+    feedback = CardinalityFeedback(path=str(tmp_path / 'feedback.json'))
+    feedback.learn_from_explain([{'Plan': explain_scan(
+        'lineitem', 'l', "((l_shipmode = ANY ('{MAIL,SHIP}'::bpchar[])) AND (l_quantity < '24'::numeric))",
+        rows=100, removed=900)}])
+    assert feedback.lookup("WHERE l.l_quantity < 24 AND l.l_shipmode IN ('MAIL', 'SHIP')", {'lineitem'}) == \
+        pytest.approx(0.1)
+    # a filter on another table is a different key
+    assert feedback.lookup("WHERE l.l_quantity < 24 AND l.l_shipmode IN ('MAIL', 'SHIP')", {'orders'}) is None
+
+
+def test_learn_hash_join(tmp_path):
+    feedback = CardinalityFeedback(path=str(tmp_path / 'feedback.json'))
+    feedback.learn_from_explain({'Plan': {
+        'Node Type': 'Hash Join', 'Hash Cond': '(o.o_custkey = c.c_custkey)', 'Actual Rows': 500, 'Actual Loops': 1,
+        'Plans': [
+            {'Node Type': 'Seq Scan', 'Relation Name': 'orders', 'Alias': 'o', 'Actual Rows': 1000, 'Actual Loops': 1},
+            {'Node Type': 'Hash', 'Actual Rows': 100, 'Actual Loops': 1, 'Plans': [
+                {'Node Type': 'Seq Scan', 'Relation Name': 'customer', 'Alias': 'c',
+                 'Actual Rows': 100, 'Actual Loops': 1}]},
+        ]}})
+    assert feedback.lookup("c.c_custkey = o.o_custkey", {'orders', 'customer'}) == pytest.approx(500 / (1000 * 100))
+
+
+def test_learn_nested_loop_per_loop(tmp_path):
+    # the inner index scan runs once per outer row and reports its rows per loop
+    feedback = CardinalityFeedback(path=str(tmp_path / 'feedback.json'))
+    feedback.learn_from_explain({'Plan': {
+        'Node Type': 'Nested Loop', 'Join Filter': '(o.o_totalprice > c.c_acctbal)', 'Actual Rows': 10,
+        'Actual Loops': 1, 'Plans': [
+            {'Node Type': 'Seq Scan', 'Relation Name': 'customer', 'Alias': 'c', 'Actual Rows': 20, 'Actual Loops': 1},
+            {'Node Type': 'Index Scan', 'Relation Name': 'orders', 'Alias': 'o', 'Actual Rows': 20, 'Actual Loops': 20},
+        ]}})
+    assert feedback.lookup("o.o_totalprice > c.c_acctbal", {'orders', 'customer'}) == pytest.approx(10 / (20 * 20))
+
+
+def test_pushed_down_selections_find_learned_conjunction(tmp_path):
+    feedback = CardinalityFeedback(path=str(tmp_path / 'feedback.json'))
+    feedback.learn_from_explain(explain_scan(
+        'lineitem', 'l', "((l_discount >= 0.05) AND (l_discount <= 0.07) AND (l_quantity < '24'::numeric))",
+        rows=30, removed=970))
+    tree = pushdown_selections(Selection(
+        "WHERE l.l_quantity < 24 AND l.l_discount BETWEEN 0.05 AND 0.07 AND o.o_orderstatus = 'F'",
+        Join(Relation("lineitem", "l"), Relation("orders", "o"), "l.l_orderkey = o.o_orderkey")))
+    estimate_cost(tree, {'lineitem': 6000, 'orders': 1500}, feedback)
+    # the stack of two selections over lineitem ends with the learned 3%
+    assert tree.left.rows == pytest.approx(6000 * 0.03)
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cost_calibration import COEFFICIENTS, CostProfile, collect_observations, fit_profile, load_profile
+
+# Parallel hash join: the leader and two workers each scan a third of orders and build the whole hash
+GATHER_PLAN = {'Plan': {
+    'Node Type': 'Gather', 'Workers Launched': 2, 'Actual Rows': 300, 'Actual Loops': 1, 'Actual Total Time': 100.0,
+    'Plans': [{
+        'Node Type': 'Hash Join', 'Hash Cond': '(o.o_custkey = c.c_custkey)', 'Actual Rows': 100,
+        'Actual Loops': 3, 'Actual Total Time': 90.0,
+        'Plans': [
+            {'Node Type': 'Seq Scan', 'Parallel Aware': True, 'Relation Name': 'orders', 'Alias': 'o',
+             'Actual Rows': 1000, 'Actual Loops': 3, 'Actual Total Time': 30.0},
+            {'Node Type': 'Hash', 'Actual Rows': 50, 'Actual Loops': 3, 'Actual Total Time': 20.0, 'Plans': [
+                {'Node Type': 'Seq Scan', 'Relation Name': 'customer', 'Alias': 'c',
+                 'Actual Rows': 50, 'Actual Loops': 3, 'Actual Total Time': 10.0}]},
+        ]}]}}
+
+
+def test_join_selectivity_under_gather():
+    _, selectivities = collect_observations(GATHER_PLAN)
+    # 3000 orders rows in total, each matched against the 50 customers in every worker's hash
+    assert selectivities['join'] == [pytest.approx(300 / (3000 * 50))]
+
+
+def test_times_under_gather_are_elapsed():
+    observations, _ = collect_observations(GATHER_PLAN)
+    join_features, join_ms = next((f, t) for f, t in observations if 'hash_probe_tuple' in f)
+    assert join_ms == pytest.approx(90.0 - 30.0 - 20.0)
+    # each of the three processes probes its third of the outer rows
+    assert join_features['hash_probe_tuple'] == pytest.approx(1000)
+
+
+def test_unfitted_coefficients_are_not_saved(tmp_path):
+    profile = fit_profile([GATHER_PLAN], name='partial')
+    # no filters and no buffer counts in the plan
+    assert set(profile.unfitted()) == {'filter_tuple', 'io_page'}
+    with pytest.raises(ValueError):
+        profile.save(str(tmp_path / 'partial.json'))
+
+
+def test_profile_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr('cost_calibration.PROFILE_DIR', str(tmp_path))
+    CostProfile(name='full', coefficients={c: 0.001 for c in COEFFICIENTS}).save()
+    assert load_profile('full').coefficients == {c: 0.001 for c in COEFFICIENTS}
@@ -0,0 +1,90 @@
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import permutations
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cost_calibration import CostProfile
+import join_optimization
+from join_optimization import _edge_rows, _edge_cost, _dp_search
+
+PROFILE = CostProfile(coefficients={'hash_probe_tuple': 0.002, 'hash_build_tuple': 0.005, 'output_tuple': 0.001})
+
+
+def order_cost(perm, edge_ends, rows, selectivities, profile):
+    """Cost of joining the edges in this order, or None if some edge is not connected when it is joined."""
+    a, b = edge_ends[perm[0]]
+    visited = {a, b}
+    curr_rows = _edge_rows(selectivities[perm[0]], rows[a], rows[b], profile)
+    cost = _edge_cost(rows[a], rows[b], curr_rows, profile)
+    for i in perm[1:]:
+        a, b = edge_ends[i]
+        if a in visited:
+            other = b
+        elif b in visited:
+            other = a
+        else:
+            return None
+        visited.add(other)
+        out_rows = _edge_rows(selectivities[i], curr_rows, rows[other], profile)
+        cost += _edge_cost(curr_rows, rows[other], out_rows, profile)
+        curr_rows = out_rows
+    return cost
+
+
+def enumerate_orders(edge_ends, rows, selectivities, profile):
+    """The full enumeration the search replaced: cheapest connected permutation."""
+    costs = (order_cost(perm, edge_ends, rows, selectivities, profile) for perm in permutations(range(len(edge_ends))))
+    return min(cost for cost in costs if cost is not None)
+
+
+def random_join_graph(rng, n_edges):
+    """A connected join graph with n_edges edges, possibly with cycles."""
+    n_relations = rng.randint(max(2, n_edges // 2 + 1), n_edges + 1)
+    edge_ends = [(rng.randrange(i), i) for i in range(1, n_relations)]
+    while len(edge_ends) < n_edges:
+        a, b = rng.sample(range(n_relations), 2)
+        edge_ends.append((a, b))
+    rng.shuffle(edge_ends)
+    rows = [rng.choice([10, 1000, 150000, 6000000]) * rng.random() + 1 for _ in range(n_relations)]
+    selectivities = [rng.choice([None, 1e-6, 1e-3, 0.05, rng.random()]) for _ in edge_ends]
+    return edge_ends, rows, selectivities
+
+
+@pytest.mark.parametrize('profile', [None, PROFILE], ids=['rows', 'profile'])
+@pytest.mark.parametrize('seed', range(40))
+def test_dp_matches_enumeration(seed, profile, monkeypatch):
+    rng = random.Random(seed)
+    edge_ends, rows, selectivities = random_join_graph(rng, rng.randint(2, 6))
+    expected_cost = enumerate_orders(edge_ends, rows, selectivities, profile)
+
+    cost, order, _, _ = _dp_search(edge_ends, rows, selectivities, profile)
+    assert cost == pytest.approx(expected_cost)
+    assert order_cost(order, edge_ends, rows, selectivities, profile) == pytest.approx(cost)
+
+    # split every level across the workers, however small
+    monkeypatch.setattr(join_optimization, 'PARALLEL_MIN_STATES', 1)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        parallel_cost, parallel_order, _, _ = _dp_search(edge_ends, rows, selectivities, profile, executor)
+    assert (parallel_cost, parallel_order) == (cost, order)
+
+
+def test_dp_handles_large_chain():
+    rng = random.Random(315)
+    edge_ends = [(i, i + 1) for i in range(19)]
+    rows = [rng.randint(10, 6000000) for _ in range(20)]
+    selectivities = [1 / max(rows[a], rows[b]) for a, b in edge_ends]
+    cost, order, subsets, _ = _dp_search(edge_ends, rows, selectivities, PROFILE)
+    assert sorted(order) == list(range(19))
+    assert order_cost(order, edge_ends, rows, selectivities, PROFILE) == pytest.approx(cost)
+    # connected subsets of a chain are its intervals
+    assert subsets == 19 * 20 // 2
+
+
+def test_dp_reports_disconnected_graph():
+    cost, order, _, _ = _dp_search([(0, 1), (2, 3)], [10, 20, 30, 40], [None, None], None)
+    assert order is None
@@ -0,0 +1,76 @@
+import datetime
+import os
+import random
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sampling_estimator import SamplingEstimator
+
+MODES = ['MAIL', 'SHIP', 'AIR', 'AIR REG', 'RAIL', 'TRUCK', 'FOB']
+
+
+def lineitem_sample(n=1000):
+    rng = random.Random(315)
+    return [{'l_quantity': rng.randint(1, 50), 'l_discount': Decimal(rng.randint(0, 10)) / 100,
+             'l_shipmode': rng.choice(MODES),
+             'l_shipdate': datetime.date(1992, 1, 1) + datetime.timedelta(rng.randint(0, 2500)),
+             'l_comment': rng.choice(['green box', 'blue', None])} for _ in range(n)]
+
+
+def sampler_with(rows, **kwargs):
+    sampler = SamplingEstimator(**kwargs)
+    sampler._samples['lineitem'] = rows
+    return sampler
+
+
+@pytest.mark.parametrize('condition, predicate', [
+    ("WHERE l.l_quantity < 24 AND l.l_discount BETWEEN 0.05 AND 0.07",
+     lambda r: r['l_quantity'] < 24 and Decimal('0.05') <= r['l_discount'] <= Decimal('0.07')),
+    ("WHERE l.l_shipmode IN ('MAIL', 'SHIP')", lambda r: r['l_shipmode'] in ('MAIL', 'SHIP')),
+    ("WHERE l.l_shipmode LIKE '%AIR%' OR l.l_quantity * 2 > 90", lambda r: 'AIR' in r['l_shipmode'] or r['l_quantity'] > 45),
+    ("WHERE l.l_shipdate >= CAST('1994-01-01' AS DATE) AND l.l_shipdate < CAST('1995-01-01' AS DATE)",
+     lambda r: datetime.date(1994, 1, 1) <= r['l_shipdate'] < datetime.date(1995, 1, 1)),
+    # NOT LIKE on NULL is unknown, so NULL rows do not match
+    ("WHERE l.l_comment NOT LIKE '%green%'", lambda r: r['l_comment'] is not None and 'green' not in r['l_comment']),
+    ("WHERE l.l_comment IS NULL", lambda r: r['l_comment'] is None),
+])
+def test_column_wise_selectivity(condition, predicate):
+    rows = lineitem_sample()
+    expected = sum(1 for row in rows if predicate(row)) / len(rows)
+    assert sampler_with(rows).selectivity('lineitem', 'l', condition) == pytest.approx(expected)
+
+
+def test_unsupported_predicate_falls_back_to_executor():
+    rows = lineitem_sample(100)
+    expected = sum(1 for row in rows if row['l_shipmode'].lower() == 'mail') / len(rows)
+    assert sampler_with(rows).selectivity('lineitem', 'l', "WHERE LOWER(l.l_shipmode) = 'mail'") == \
+        pytest.approx(expected)
+
+
+def test_estimates_are_bounded():
+    sampler = sampler_with(lineitem_sample(100), max_estimates=3)
+    for quantity in range(10):
+        sampler.selectivity('lineitem', 'l', f"WHERE l.l_quantity < {quantity}")
+    assert len(sampler._estimates) == 3
+
+
+def test_failed_fetch_is_retried(monkeypatch):
+    calls = []
+
+    def failing_connect():
+        calls.append(1)
+        raise ConnectionError("database unavailable")
+
+    sampler = SamplingEstimator(connect=failing_connect, retry_after=60)
+    now = [1000.0]
+    monkeypatch.setattr('sampling_estimator.time.time', lambda: now[0])
+    assert sampler.selectivity('orders', 'o', "WHERE o.o_orderstatus = 'F'") is None
+    assert sampler.selectivity('orders', 'o', "WHERE o.o_orderstatus = 'F'") is None
+    assert len(calls) == 1
+    now[0] += 61
+    assert sampler.selectivity('orders', 'o', "WHERE o.o_orderstatus = 'F'") is None
+    assert len(calls) == 2